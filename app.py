@@ -1,52 +1,268 @@
-from flask import Flask, render_template, request
-from chordgenerator import generatechords, chords_to_chordsymbols, chords_to_midi, process_roman_numeral_analysis
-from mingus.core.mt_exceptions import NoteFormatError
-from mingus.core.notes import note_to_int
-from mingus.core.intervals import major_third, minor_fifth, perfect_fifth
-from colorsys import hsv_to_rgb
+from flask import Flask, Response, abort, jsonify, make_response, render_template, request, url_for
+from chordgenerator import chords_to_chordshorthands
+from executor import GENERATION_DEADLINE_MS, MAX_BATCH_SIZE, PAGE_NUMBARS, GenerationExecutor, GenerationUnavailable
+from instrumentation import METRICS, configure_logging, process_memory
+from midicache import MIDI_CACHE, midi_digest, midi_bytes
+from prefetch import Prefetcher
+from progressionrenderer import (DEFAULT_RANDOMFACTOR, MIN_RANDOMFACTOR, MAX_RANDOMFACTOR, MAX_SEED, DRAW_COUNTERS,
+                                 RESULT_CACHE, RenderedProgression, clamp_randomfactor, random_seed,
+                                 render_seeded_progression, cache_progression)
+from collections import deque
+from typing import Iterator
+import ipaddress
+import json
+import os
+import tablecache
+import numpy as np
 
+configure_logging()
+tablecache.load_tables()  # Under gunicorn's preload_app, once in the master, and shared with the workers it forks
 app = Flask(__name__)
 app.jinja_env.filters['zip'] = zip
 
-global randomfactor
+# MIDI is served by content address, so a response never goes stale:
+MIDI_MAX_AGE = 365 * 24 * 60 * 60
+
+# Progressions served by seed only change when the generator does:
+SEEDED_MAX_AGE = 7 * 24 * 60 * 60
+
+# Limits on what the API generates per request. Streamed responses are also limited in the bars they generate in all
+# (count * numbars), so that one finishes well within gunicorn's worker timeout (30 seconds by default):
+MAX_API_NUMBARS = 10000
+MAX_API_COUNT = 10000
+MAX_API_BARS = 100000
+
+# Most bars a MIDI URL is given for. The URL carries 4 characters per bar, and its request line ('GET /midi/<32 hex
+# digits>.mid?bars=... HTTP/1.1', 61 characters plus the bars) has to fit in gunicorn's limit_request_line of 4094
+# bytes. Longer progressions are returned without one:
+MAX_MIDI_URL_BARS = 960
+
+# Addresses (or networks) the metrics are served to, comma-separated. Anywhere else they're not found. Only loopback by
+# default; behind a proxy, this is matched against the proxy's address:
+METRICS_ALLOW = [ipaddress.ip_network(network.strip(), strict=False)
+                 for network in os.environ.get('METRICS_ALLOW', '127.0.0.0/8,::1').split(',') if network.strip()]
+
+# How many progressions a streamed response keeps rendering ahead of the one it's sending:
+STREAM_AHEAD = 4 * MAX_BATCH_SIZE
+
+# Generation, analysis and rendering all happen in a pool of processes:
+EXECUTOR = GenerationExecutor()
+
+# Progressions rendered ahead of time, by randomness slider value:
+PREFETCHER = Prefetcher(lambda randomfactor: EXECUTOR.render(randomfactor, PAGE_NUMBARS, random_seed()))
+
+METRICS.add_collector(DRAW_COUNTERS.collect)
+METRICS.add_collector(lambda: [('ohmychord_prefetch_hits_total', 'counter', {}, PREFETCHER.hits),
+                               ('ohmychord_prefetch_misses_total', 'counter', {}, PREFETCHER.misses),
+                               ('ohmychord_midi_cache_hits_total', 'counter', {}, MIDI_CACHE.hits),
+                               ('ohmychord_midi_cache_misses_total', 'counter', {}, MIDI_CACHE.misses),
+                               ('ohmychord_midi_cache_entries', 'gauge', {}, len(MIDI_CACHE)),
+                               ('ohmychord_midi_cache_bytes', 'gauge', {}, MIDI_CACHE.currentbytes),
+                               ('ohmychord_result_cache_hits_total', 'counter', {}, RESULT_CACHE.hits),
+                               ('ohmychord_result_cache_misses_total', 'counter', {}, RESULT_CACHE.misses),
+                               ('ohmychord_result_cache_entries', 'gauge', {}, len(RESULT_CACHE)),
+                               ('ohmychord_result_cache_bytes', 'gauge', {}, RESULT_CACHE.currentbytes),
+                               ('ohmychord_generation_renders_total', 'counter', {}, EXECUTOR.renders),
+                               ('ohmychord_generation_batches_total', 'counter', {}, EXECUTOR.batches),
+                               ('ohmychord_precomputed_samplers', 'gauge', {}, tablecache.loaded_samplers),
+                               ('ohmychord_precomputed_load_seconds', 'gauge', {}, tablecache.load_seconds)])
+METRICS.add_collector(process_memory)
+
 
 @app.route('/', methods=('GET', 'POST'))
 def index():
-    if request.method == 'POST':
-        randomfactor = int(request.form['randomness-slider'])
-    validchords = False
-    while not validchords:
+    with METRICS.timed('request'):
+        randomfactor = DEFAULT_RANDOMFACTOR
+        if request.method == 'POST':
+            randomfactor = clamp_randomfactor(int(request.form['randomness-slider']))
+        with METRICS.timed('prefetch'):
+            progression = PREFETCHER.get(randomfactor, render=_render_within_deadline)
+        cache_progression(progression)
+        MIDI_CACHE.put(progression.midi_digest, progression.midi)
+        with METRICS.timed('render_template'):
+            return _render_page(progression)
+
+
+# A progression's own page, which always shows the same progression (so it can be shared and cached):
+@app.route('/p/<int:seed>')
+def shared_progression(seed: int):
+    if seed > MAX_SEED:
+        abort(404)
+    with METRICS.timed('request'):
+        progression = render_seeded_progression(seed, _int_arg('r', DEFAULT_RANDOMFACTOR, MIN_RANDOMFACTOR,
+                                                                MAX_RANDOMFACTOR), render=EXECUTOR.render)
+        MIDI_CACHE.put(progression.midi_digest, progression.midi)
+        with METRICS.timed('render_template'):
+            response = make_response(_render_page(progression))
+        return _cacheable(response, SEEDED_MAX_AGE)
+
+
+# A progression for the page that isn't ready ahead of time. Rather than hold the worker up for as long as it takes, the
+# page falls back to one rendered earlier once the deadline's up:
+def _render_within_deadline(randomfactor: int) -> RenderedProgression:
+    return EXECUTOR.render_within(GENERATION_DEADLINE_MS / 1000, randomfactor, PAGE_NUMBARS, random_seed())
+
+
+def _render_page(progression: RenderedProgression) -> str:
+    return render_template('index.html', chords=progression.chordsymbols, hues=progression.hues,
+                           numerals=progression.numerals, randomfactor=progression.randomfactor,
+                           midi_url=progression_midi_url(progression.midi_token, progression.midi_digest),
+                           share_url=url_for('shared_progression', seed=progression.seed,
+                                             r=progression.randomfactor))
+
+
+# Tags a response that only depends on its URL with a strong ETag (of its body) and lets browsers and CDNs keep it,
+# answering requests for what they already have with a 304:
+def _cacheable(response: Response, max_age: int) -> Response:
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+# The URL carries the progression's MIDI token along with its digest, so whichever worker gets the request can render
+# the MIDI if it doesn't have it cached:
+def progression_midi_url(token: str, digest: str) -> str:
+    return url_for('progression_midi', digest=digest, bars=token)
+
+
+@app.route('/midi/<digest>.mid')
+def progression_midi(digest: str):
+    token = request.args.get('bars', '')
+    if (len(token) > 4 * MAX_MIDI_URL_BARS) or (midi_digest(token) != digest):
+        abort(404)
+    if digest in request.if_none_match:
+        response = Response(status=304)
+    else:
         try:
-            try:
-                randomfactor_as_decimal = 1 - (randomfactor / 100)
-            except UnboundLocalError:
-                randomfactor = 50
-                randomfactor_as_decimal = 0.5
-            print(f'randomfactor: {randomfactor_as_decimal}')
-            chords, keys, numerals = generatechords(return_functional_analysis=True, numbars=4,
-                                                    diatonicity_factor=randomfactor_as_decimal,
-                                                    functionalharmony_factor=randomfactor_as_decimal)
-            numerals = process_roman_numeral_analysis(chords, keys, numerals)
-            chordsymbols = chords_to_chordsymbols(chords)
-            validchords = chordsymbols is not None
-        except (ValueError, NoteFormatError, IndexError) as e:
-            print(e)
-
-    chords_to_midi(chords)
-
-    if chordsymbols is None:
-        print('Mettu')
-        print(chordsymbols)
-
-    # Color chords based on quality:
-    hues = ['#%02x%02x%02x' %
-            tuple(map(lambda x: round(x * 255), hsv_to_rgb(
-                ((((note_to_int(c[0]) * 15) + (320 if (major_third(c[0]) == c[1]) else 140)) % 360) / 360),
-                0.28, 0.54))) for c in chords]  # s = 0.54-0.57, v = 0.60-0.62 -> s = 0.24-0.32, v = 0.54
-    # hues = [((note_to_int(c[0]) * 15) + (320 if (major_third(c[0]) == c[1]) else 140)) % 360
-    #         for c in chords]
-    print(hues)
-    return render_template('index.html', chords=chordsymbols, hues=hues, numerals=numerals, randomfactor=randomfactor)
+            response = Response(midi_bytes(token), mimetype='audio/midi')
+        except ValueError:
+            abort(404)
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = MIDI_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+# One progression as JSON, for explicit parameters (randomness in percent, like the slider). Without a seed, one is
+# picked and returned, so the progression can be asked for again. Its MIDI URL is only given up to MAX_MIDI_URL_BARS:
+@app.route('/api/progression')
+def progression_json():
+    randomfactor = _int_arg('randomness', DEFAULT_RANDOMFACTOR, MIN_RANDOMFACTOR, MAX_RANDOMFACTOR)
+    numbars = _int_arg('numbars', 4, 1, MAX_API_NUMBARS)
+    seed = _int_arg('seed', None, 0, MAX_SEED)
+    with METRICS.timed('api_progression'):
+        if seed is None:
+            progression = EXECUTOR.render(randomfactor, numbars, random_seed(), bulk=True)
+            cache_progression(progression)
+        else:
+            progression = render_seeded_progression(seed, randomfactor, numbars, render=_render_bulk)
+        if numbars <= MAX_MIDI_URL_BARS:
+            MIDI_CACHE.put(progression.midi_digest, progression.midi)
+        response = jsonify(_progression_dict(progression, with_midi_url=numbars <= MAX_MIDI_URL_BARS))
+        return response if seed is None else _cacheable(response, SEEDED_MAX_AGE)
+
+
+# Many progressions as newline-delimited JSON, generated as the response is sent (up to STREAM_AHEAD at a time, across
+# the pool's processes). Each one gets its own seed (drawn from the request's seed), which /api/progression takes to
+# render it again:
+@app.route('/api/progressions')
+def progressions_ndjson():
+    randomfactor = _int_arg('randomness', DEFAULT_RANDOMFACTOR, MIN_RANDOMFACTOR, MAX_RANDOMFACTOR)
+    numbars = _int_arg('numbars', 4, 1, MAX_API_NUMBARS)
+    count = _int_arg('count', 10, 0, MAX_API_COUNT)
+    seed = _int_arg('seed', None, 0, MAX_SEED)
+    if count * numbars > MAX_API_BARS:
+        abort(400, f'count * numbars must be at most {MAX_API_BARS}')
+    seeds = np.random.default_rng(random_seed() if seed is None else seed)
+
+    def submit_next(pending: deque):
+        pending.append(EXECUTOR.submit(randomfactor, numbars, int(seeds.integers(MAX_SEED, endpoint=True)), bulk=True))
+
+    def generate() -> Iterator[str]:
+        pending = deque()
+        for _ in range(min(count, STREAM_AHEAD)):
+            submit_next(pending)
+        for index in range(count):
+            progression = pending.popleft().result()
+            if index + len(pending) + 1 < count:
+                submit_next(pending)
+            yield json.dumps(dict(_progression_dict(progression, with_midi_url=False), index=index)) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# Renders for the API wait behind the page's (see GenerationExecutor):
+def _render_bulk(randomfactor: int, numbars: int, seed: int) -> RenderedProgression:
+    return EXECUTOR.render(randomfactor, numbars, seed, bulk=True)
+
+
+def _progression_dict(progression: RenderedProgression, with_midi_url: bool = True) -> dict:
+    chords = progression.chords
+    progression_dict = {'randomness': progression.randomfactor,
+                        'numbars': progression.numbars,
+                        'seed': progression.seed,
+                        'chords': [list(chord) for chord in chords],
+                        'chordsymbols': chords_to_chordshorthands(chords),
+                        'chordsymbols_html': progression.chordsymbols,
+                        'numerals': progression.analyses,
+                        'numerals_html': progression.numerals,
+                        'keys': progression.keys,
+                        'hues': progression.hues}
+    if with_midi_url:
+        progression_dict['midi_url'] = progression_midi_url(progression.midi_token, progression.midi_digest)
+    return progression_dict
+
+
+def _int_arg(name: str, default: int | None, minimum: int, maximum: int) -> int | None:
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, f'{name} must be an integer')
+    if not minimum <= value <= maximum:
+        abort(400, f'{name} must be between {minimum} and {maximum}')
+    return value
+
+
+@app.errorhandler(400)
+def bad_request(error):
+    if request.path.startswith('/api/'):
+        return jsonify(error=error.description), 400
+    return error
+
+
+# A page request that ran out of time before the pool had rendered anything to fall back on (e.g. as it starts up):
+@app.errorhandler(GenerationUnavailable)
+def generation_unavailable(error):
+    return Response('Progressions are still being prepared, try again in a moment.', status=503,
+                    headers={'Retry-After': '1'}, mimetype='text/plain')
+
+
+def _check_metrics_allowed():
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        abort(404)
+    if not any(address in network for network in METRICS_ALLOW):
+        abort(404)
+
+
+# Stage timings, retries and cache counters of this worker process, in the Prometheus text format:
+@app.route('/metrics')
+def metrics():
+    _check_metrics_allowed()
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Draws it's taken to generate progressions, by randomness slider value:
+@app.route('/metrics/retries')
+def retry_metrics():
+    _check_metrics_allowed()
+    return jsonify(DRAW_COUNTERS.snapshot())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+from chordgenerator import (GENERATION_ERRORS, generatechords, generatechords_iter, generatechords_batch,
+                            key_center_distance, process_roman_numeral_analysis, chords_to_chordsymbols,
+                            chords_to_midi, chords_to_midi_bytes, chords_to_midi_batch_bytes)
+from chordsampler import compiled_sampler
+from theorytables import KEY_NAMES
+from typing import Callable
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np
+
+# Seed every case's random draws start from, so runs are repeatable:
+SEED = 0
+
+# Slider factors and progression lengths the generator is benchmarked at:
+FACTORS = (0.1, 0.5, 0.9)
+NUMBARS = (4, 16, 100, 1000, 10000)
+
+# Progressions per generatechords_batch() call:
+BATCH_SIZE = 10
+
+# Timing rounds per case, and the least time (in seconds) each round should take:
+ROUNDS = 5
+MIN_ROUND_TIME = 0.2
+
+# How much slower than the baseline (as a fraction of it) a case has to get to be flagged:
+REGRESSION_THRESHOLD = 0.1
+
+# Benchmark cases by name. Each one sets up its inputs and returns the call to time:
+CASES = {}
+
+
+def case(name: str):
+    def register(setup: Callable[[], Callable[[], object]]):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def _seed(seed: int = SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+# Progressions that can be analyzed and named, to feed the cases after generation:
+def _valid_progressions(n: int = 64, numbars: int = 4) -> list[tuple[list, list, list]]:
+    rng = np.random.default_rng(SEED)
+    return [tuple(compiled_sampler(0.5, 0.5).sample_valid(rng, numbars)[:3]) for _ in range(n)]
+
+
+# The generator is called over and over, throwing out progressions it raises on (as the page used to), so the time
+# of a call includes the ones that failed partway:
+def _generatechords_case(factor: float, numbars: int) -> Callable[[], object]:
+    _seed()
+
+    def run():
+        try:
+            return generatechords(factor, factor, numbars)
+        except GENERATION_ERRORS:
+            return None
+    return run
+
+
+def _generatechords_iter_case(factor: float, numbars: int) -> Callable[[], object]:
+    _seed()
+    return lambda: sum(1 for _ in generatechords_iter(factor, factor, numbars))
+
+
+def _sample_valid_case(factor: float, numbars: int) -> Callable[[], object]:
+    sampler = compiled_sampler(factor, factor)
+    sampler.compile_all()  # Otherwise the first rounds would mostly time compiling states
+    rng = np.random.default_rng(SEED)
+    return lambda: sampler.sample_valid(rng, numbars)
+
+
+# Batches of BATCH_SIZE progressions, so that the time per bar can be compared across numbars:
+def _generatechords_batch_case(factor: float, numbars: int) -> Callable[[], object]:
+    compiled_sampler(factor, factor).compile_all()
+    rng = np.random.default_rng(SEED)
+    return lambda: generatechords_batch(BATCH_SIZE, factor, factor, numbars, seed=rng)
+
+
+for _factor, _numbars in itertools.product(FACTORS, NUMBARS):
+    case(f'generatechords[factor={_factor},numbars={_numbars}]')(
+        lambda factor=_factor, numbars=_numbars: _generatechords_case(factor, numbars))
+    case(f'generatechords_iter[factor={_factor},numbars={_numbars}]')(
+        lambda factor=_factor, numbars=_numbars: _generatechords_iter_case(factor, numbars))
+    case(f'sample_valid[factor={_factor},numbars={_numbars}]')(
+        lambda factor=_factor, numbars=_numbars: _sample_valid_case(factor, numbars))
+    case(f'generatechords_batch[{BATCH_SIZE} x factor={_factor},numbars={_numbars}]')(
+        lambda factor=_factor, numbars=_numbars: _generatechords_batch_case(factor, numbars))
+
+
+@case('key_center_distance[all key pairs]')
+def _key_center_distance_case() -> Callable[[], object]:
+    pairs = list(itertools.product(KEY_NAMES, KEY_NAMES))
+    return lambda: [key_center_distance(k1, k2) for k1, k2 in pairs]
+
+
+@case('key_center_distance[spelled keys]')
+def _spelled_key_center_distance_case() -> Callable[[], object]:
+    pairs = list(itertools.product(('C', 'E#', 'Fb', 'a', 'e#', 'fb'), ('G', 'B#', 'Cb', 'd', 'b#', 'cb')))
+
+    def run():
+        for k1, k2 in pairs:
+            try:
+                key_center_distance(k1, k2)
+            except GENERATION_ERRORS:
+                pass
+    return run
+
+
+@case('process_roman_numeral_analysis[64 x 4 bars]')
+def _analysis_case() -> Callable[[], object]:
+    progressions = _valid_progressions()
+    return lambda: [process_roman_numeral_analysis(*p) for p in progressions]
+
+
+@case('chords_to_chordsymbols[64 x 4 bars]')
+def _chordsymbols_case() -> Callable[[], object]:
+    progressions = _valid_progressions()
+    return lambda: [chords_to_chordsymbols(p[0]) for p in progressions]
+
+
+@case('chords_to_midi_bytes[64 x 4 bars]')
+def _midi_bytes_case() -> Callable[[], object]:
+    progressions = _valid_progressions()
+    return lambda: [chords_to_midi_bytes(p[0]) for p in progressions]
+
+
+@case('chords_to_midi[file, 4 bars]')
+def _midi_file_case() -> Callable[[], object]:
+    chords_ = _valid_progressions(1)[0][0]
+    path = tempfile.mkdtemp()
+    return lambda: chords_to_midi(chords_, path)
+
+
+@case('chords_to_midi_batch_bytes[1000 x 4 bars]')
+def _midi_batch_case() -> Callable[[], object]:
+    progressions = [p[0] for p in _valid_progressions(1000)]
+    return lambda: chords_to_midi_batch_bytes(progressions)
+
+
+# The page, with prefetching turned off so that every request generates and renders its progression (inline, rather
+# than timing the round trip to the process pool):
+def _index_case(method: str) -> Callable[[], object]:
+    import app
+    app.PREFETCHER.depth = 0
+    app.EXECUTOR.processes = 0
+    client = app.app.test_client()
+    if method == 'GET':
+        request = lambda: client.get('/')
+    else:
+        request = lambda: client.post('/', data={'randomness-slider': '50'})
+    compiled_sampler(0.5, 0.5).compile_all()  # Both requests are at the default randomness, 50%
+
+    def run():
+        response = request()
+        assert response.status_code == 200
+    return run
+
+
+case('index[GET]')(lambda: _index_case('GET'))
+case('index[POST]')(lambda: _index_case('POST'))
+
+
+# Starting a worker in a fresh interpreter: importing the app (which loads the precomputed tables, if they've been
+# built with tablecache.py) and serving its first pages. Pages are rendered inline, so that it times generation rather
+# than starting the process pool:
+def _startup_case(pages: int, tables: bool = True) -> Callable[[], object]:
+    env = dict(os.environ, GENERATION_PROCESSES='0', PREFETCH_DEPTH='0')
+    if not tables:
+        env['TABLE_CACHE_PATH'] = ''
+    command = [sys.executable, '-c',
+               f"import app; client = app.app.test_client(); [client.get('/') for _ in range({pages})]"]
+    return lambda: subprocess.run(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+
+case('startup[import app]')(lambda: _startup_case(0))
+case('startup[import app, 100 pages]')(lambda: _startup_case(100))
+case('startup[import app, 100 pages, no precomputed tables]')(lambda: _startup_case(100, tables=False))
+
+
+# Times a case's call in rounds of enough calls to take at least MIN_ROUND_TIME each, per call in seconds:
+def run_case(name: str, rounds: int = ROUNDS, min_round_time: float = MIN_ROUND_TIME) -> dict:
+    timer = timeit.Timer(CASES[name]())
+    number = 1
+    while timer.timeit(number) < min_round_time:
+        number *= 2 if number < 1000 else 10
+    times = [t / number for t in timer.repeat(rounds, number)]
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.fmean(times),
+            'rounds': rounds, 'number': number}
+
+
+def run(names: list[str], rounds: int = ROUNDS, min_round_time: float = MIN_ROUND_TIME) -> dict:
+    results = {}
+    for name in names:
+        results[name] = run_case(name, rounds, min_round_time)
+        print(f'{name}: {_format_seconds(results[name]["median"])}', file=sys.stderr)
+    return {'metadata': {'python': platform.python_version(), 'numpy': np.__version__,
+                         'platform': platform.platform(), 'seed': SEED, 'time': time.time()},
+            'results': results}
+
+
+# Cases that got slower than the baseline by more than the threshold, as (name, baseline, current) medians:
+def regressions(results: dict, baseline: dict,
+                threshold: float = REGRESSION_THRESHOLD) -> list[tuple[str, float, float]]:
+    return [(name, baseline['results'][name]['median'], result['median'])
+            for name, result in results['results'].items()
+            if ((name in baseline['results'])
+                and (result['median'] > baseline['results'][name]['median'] * (1 + threshold)))]
+
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> str:
+    lines = []
+    flagged = {name for name, _, _ in regressions(results, baseline, threshold)}
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            lines.append(f'  {name}: {_format_seconds(result["median"])} (not in baseline)')
+            continue
+        ratio = result['median'] / baseline['results'][name]['median']
+        lines.append(f'{"!" if name in flagged else " "} {name}: {_format_seconds(result["median"])} vs. '
+                     f'{_format_seconds(baseline["results"][name]["median"])} ({ratio:.2f}x)')
+    return '\n'.join(lines)
+
+
+def _format_seconds(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.3f} {unit}'
+    return f'{seconds / 1e-9:.1f} ns'
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the generator, analysis, chord symbols, MIDI, the page and starting a worker.')
+    parser.add_argument('-o', '--output', help='file to write the results to, as JSON')
+    parser.add_argument('-c', '--compare', metavar='BASELINE', help='results file to flag regressions against')
+    parser.add_argument('-t', '--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='how much slower than the baseline (as a fraction) counts as a regression')
+    parser.add_argument('-k', '--filter', default='', help='only run cases whose names contain this')
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--min-round-time', type=float, default=MIN_ROUND_TIME)
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args(argv)
+
+    names = [name for name in CASES if args.filter in name]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    results = run(names, args.rounds, args.min_round_time)
+    if args.output:
+        with open(args.output, 'w') as outputfile:
+            json.dump(results, outputfile, indent=2)
+    if args.compare:
+        with open(args.compare) as baselinefile:
+            baseline = json.load(baselinefile)
+        print(compare(results, baseline, args.threshold))
+        return 1 if regressions(results, baseline, args.threshold) else 0
+    if not args.output:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,39 +1,39 @@
 from mingus.core import chords, notes, keys, intervals
-from midiutil import MIDIFile
-from typing import Union
+from mingus.core.mt_exceptions import NoteFormatError
+from typing import Iterable, Iterator, Protocol
+from chordtypes import Chord, CHORDS, Progression
+from instrumentation import METRICS
+from smfwriter import encode_smf, encode_smf_batch
+from theorytables import (PITCH_CLASS_NAMES, HARMONIC_MINOR_CHORDS, KEY_INDICES, KEY_DISTANCES, key_scale,
+                          key_chords, tonic_triad, augment_fifth, interval_shorthand)
+import itertools
+import logging
 import random
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 # Maps "strange" key signatures to more conventional ones:
 KEYSIG_CORRECTION_MAPPING = {'a#': 'bb', 'A#': 'Bb', 'cb': 'b', 'db': 'c#', 'C#': 'Db',
                              'd#': 'eb', 'D#': 'Eb', 'e#': 'f', 'F#': 'Gb', 'gb': 'f#', 'G#': 'Ab'}
 
-# Chords diatonic to the major scale:
-MAJOR_DIATONIC_CHORDS = [chords.major_triad,
-                         chords.minor_seventh,
-                         chords.minor_seventh,
-                         chords.major_seventh,
-                         chords.dominant_seventh,
-                         chords.minor_seventh,
-                         chords.half_diminished_seventh]
-
-# Chords diatonic to the minor scale:
-MINOR_DIATONIC_CHORDS = [chords.minor_triad,
-                         chords.half_diminished_seventh,
-                         chords.major_seventh,
-                         chords.minor_seventh,
-                         chords.minor_seventh,
-                         chords.major_seventh,
-                         chords.dominant_seventh]
-
 
 # Resolves key signatures not recognized by mingus:
 def resolve_key_signature(keysig: str) -> str:
     return KEYSIG_CORRECTION_MAPPING.get(keysig, keysig)
 
 
-# Defines the distance between key centers as steps around the circle of fifths:
+# Defines the distance between key centers as steps around the circle of fifths. Keys in the lookup table are measured
+# by pitch class, so enharmonic pairs the spelled intervals can't name (e.g. Gb and E, a diminished seventh) get a
+# distance rather than raising, and ones spelled across the wrap (e.g. Cb and C#) count as the pitch classes they are:
 def key_center_distance(key1: str, key2: str) -> int:
+    if (key1 in KEY_INDICES) and (key2 in KEY_INDICES):
+        return int(KEY_DISTANCES[KEY_INDICES[key1], KEY_INDICES[key2]])
+    return _spelled_key_center_distance(key1, key2)
+
+
+# Same as key_center_distance(), worked out from the spelling of keys outside the lookup table (e.g. E#, fb):
+def _spelled_key_center_distance(key1: str, key2: str) -> int:
     if key1.islower(): key1 = keys.relative_major(key1)
     if key2.islower(): key2 = keys.relative_major(key2)
     # print(key1)
@@ -52,238 +52,397 @@ def key_center_distance(key1: str, key2: str) -> int:
         case 'b7': return 2
         case '7' | 'b8' | 'b1': return 5
         case _:
-            print(intervals.determine(key1, key2, shorthand=True))
+            logger.debug('%s', intervals.determine(key1, key2, shorthand=True))
             raise ValueError(f'Invalid key centers {key1}, {key2}')
 
 
-# Parameters that the user can control (diatonicity/functional harmony rolled up into a "randomness" slider)
-diatonicity_factor = max(min(random.gauss(mu=0.56, sigma=0.2), 1), 0)  # "spice" factor
-functionalharmony_factor = max(min(random.gauss(mu=0.72, sigma=0.36), 1), 0)
-numbars = 8
+# Keys a chord can modulate to by voice-leading (common tones and small intervallic motion between chords):
+def _voice_leading_keychoices(chord: Chord) -> list[str]:
+    mediant = keys.get_notes(chord[0])[2]
+    submediant = keys.get_notes(chord[0])[5]
+    dominant = keys.get_notes(chord[0])[4]
+    if chord.is_major:
+        # major: (vi > iii) > (bVI > bIII) > (VI > III)
+        if chord.has_perfect_fifth:
+            keychoices = [mediant.lower(), submediant.lower(),
+                          notes.diminish(mediant), notes.diminish(submediant),
+                          mediant, submediant]
+        # augmented: (1, 3, 5 major)
+        else:
+            keychoices = [mediant, submediant, notes.augment(dominant)]
+    else:
+        # minor: (VI > III) > (#vi > #iii) > (vi > iii)
+        if chord.has_perfect_fifth:
+            keychoices = [notes.diminish(mediant), notes.diminish(submediant),
+                          mediant.lower(), submediant.lower(),
+                          notes.diminish(mediant).lower(), notes.diminish(submediant).lower()]
+        # diminished: (1, 3, 5, 7 minor)
+        else:
+            keychoices = [x.lower() for x in chord[:2]]
+    return [resolve_key_signature(k) for k in keychoices]
 
 
-def generatechords(diatonicity_factor: float = 0.56,
-                   functionalharmony_factor: float = 0.72,
-                   numbars: int = 4,
-                   return_functional_analysis: bool = True) \
-        -> list[list[str]] | tuple[list[list[str]], list[str], list[int]]:
-    # Randomly selects the key the progression is in:
-    startingkey = notes.int_to_note(random.randint(0, 11))
-    if random.random() < 0.5:
-        startingkey = startingkey.lower()
-    startingkey = resolve_key_signature(startingkey)
+# Voice-leading modulations out of every chord the generator can produce (chords whose root isn't a key mingus
+# recognizes can't modulate this way, and are left out):
+VOICE_LEADING_KEYCHOICES = {c: _voice_leading_keychoices(c) for c in CHORDS if keys.is_valid_key(c[0])}
+
+
+def voice_leading_keychoices(chord: Chord) -> list[str]:
+    if chord not in VOICE_LEADING_KEYCHOICES:
+        VOICE_LEADING_KEYCHOICES[chord] = _voice_leading_keychoices(chord)
+    return VOICE_LEADING_KEYCHOICES[chord]
+
+
+# Largest number of progressions generatechords_batch() samples at once:
+BATCH_CHUNK_SIZE = 4096
+
+# Exceptions the generator can raise on a bar:
+GENERATION_ERRORS = (ValueError, NoteFormatError, IndexError)
+
+# Most times generatechords_iter() redraws a bar the generator raises on before jumping to a new tonic instead:
+MAX_BAR_REDRAWS = 20
+
+# Bars per phrase generatechords_iter() generates at a time (streams of at most this many bars come out just like
+# generatechords() returns them):
+PHRASE_BARS = 16
+
+
+# Where the generator draws its random decisions from. Anything with these three methods can stand in for the ones
+# below (see chordsampler):
+class Draws(Protocol):
+    def chance(self, p: float) -> bool: ...
+
+    def randbelow(self, n: int) -> int: ...
+
+    def weighted(self, p: np.ndarray) -> int: ...
+
+
+# Draws the generator's random decisions from random/np.random's global state:
+class _GlobalRandomDraws:
+    __slots__ = ()
+
+    @staticmethod
+    def chance(p: float) -> bool:
+        return random.random() < p
+
+    @staticmethod
+    def randbelow(n: int) -> int:
+        return random.randrange(n)
+
+    @staticmethod
+    def weighted(p: np.ndarray) -> int:
+        return np.random.choice(len(p), p=p)
+
+
+# Draws the generator's random decisions from a NumPy generator of its own, so that they only depend on its seed:
+class _GeneratorDraws:
+    __slots__ = ('rng',)
+
+    def __init__(self, rng: np.random.Generator):
+        self.rng = rng
+
+    def chance(self, p: float) -> bool:
+        return self.rng.random() < p
+
+    def randbelow(self, n: int) -> int:
+        return int(self.rng.integers(n))
+
+    def weighted(self, p: np.ndarray) -> int:
+        return int(self.rng.choice(len(p), p=p))
+
+
+# Where a generator call draws from: the global random state without a seed, or its own generator with one:
+def _draws(seed: int | np.random.Generator | None) -> Draws:
+    return _GlobalRandomDraws() if seed is None else _GeneratorDraws(np.random.default_rng(seed))
+
+
+# Probability of modulating to a key, by its distance from the starting key:
+def modulation_probabilities(diatonicity_factor: float) -> np.ndarray:
     modprob_by_keydist = np.array(
         [diatonicity_factor ** i for i in range(7)])
-    modprob_by_keydist = modprob_by_keydist / modprob_by_keydist.sum()
-
-    keys_throughout_progression = [startingkey]
-    roman_numerals_throughout_progression = [0]
-    progression = [chords.I(startingkey)]
-
-    for _ in range(numbars - 1):
-        currentkey = startingkey if (random.random() < diatonicity_factor) else keys_throughout_progression[0]
-        currentkey = resolve_key_signature(currentkey)
-        # currentkey = keys_throughout_progression[0]
-        prevchord = progression[0]
-
-        # TODO: penalize circle-of-fifths distance of a (ANY) modulation from the starting key based on diatonicity_factor
-        # penalize diatonic deviations based on how long it's been since the last one and how long that one went on for
-        currchord_can_be_tonic = intervals.perfect_fifth(prevchord[0]) == prevchord[2]
-        temp_currentkey = prevchord[0]
-        if intervals.minor_third(temp_currentkey) == prevchord[1]:
-            temp_currentkey = temp_currentkey.lower()
-
-        # if (random.random() < diatonicity_factor) or (random.random() > key_center_distance()) and currchord_can_be_tonic:
-        if ((random.random() > modprob_by_keydist[key_center_distance(startingkey, temp_currentkey)])
-                and (currentkey == keys_throughout_progression[0])):
-            # if random.random() < functionalharmony_factor:
-                # Strictly diatonic functional harmony (tonics, predominants, and dominants all in the same key):
-                nextchord_roman_numeral = (roman_numerals_throughout_progression[0]
-                                           + (4 if (random.random() <= functionalharmony_factor) else 6)) % 7
-                # Plagal cadences:
-                if (len(progression) == 1) and (random.random() >= functionalharmony_factor):
-                    nextchord_roman_numeral = 3
-            # else:
-            #     # Pick a chord in the key that voice-leads smoothly:
-            #     nextchord_roman_numeral = (roman_numerals_throughout_progression[0]
-            #                                + (2 if (random.random() <= 0.5) else 5)) % 7
-        elif (random.random() < functionalharmony_factor) and currchord_can_be_tonic:
-            # Functional harmony, but allowed to assume secondary key centers:
-            currentkey = temp_currentkey
-
-            # deceptive cadences to III and VI:
-            temp_currentkey = keys.get_notes(currentkey)[mediantkey := (0 if ((len(prevchord) > 3)
-                                                                              and currentkey[0].isupper()
-                                                                              and (intervals.minor_seventh(currentkey)
-                                                                                   == prevchord[3]))
-                                                                        else random.choice([0, 2, 5]))]
-            if (currentkey != temp_currentkey) and currentkey[0].isupper():
-                currentkey = temp_currentkey.lower()
-
-            nextchord_roman_numeral = 4 if ((random.random() <= functionalharmony_factor) or (mediantkey == 5)) else 6
+    return modprob_by_keydist / modprob_by_keydist.sum()
 
-        else:
-            # Voice-leading based on common tones and intervallic distance between chords:
-            # print(prevchord)
-            # print('Voice-leading chord')
-            tonic = resolve_key_signature(prevchord[0])
-            mediant = keys.get_notes(prevchord[0])[2]
-            submediant = keys.get_notes(prevchord[0])[5]
-            dominant = keys.get_notes(prevchord[0])[4]
-            if intervals.major_third(prevchord[0]) == prevchord[1]:
-                # major: (vi > iii) > (bVI > bIII) > (VI > III)
-                if intervals.perfect_fifth(prevchord[0]) == prevchord[2]:
-                    keychoices = [mediant.lower(), submediant.lower(),
-                                  notes.diminish(mediant), notes.diminish(submediant),
-                                  mediant, submediant]
-                    keychoice_probs = np.array([modprob_by_keydist[key_center_distance(startingkey,
-                                                                                       resolve_key_signature(k))]
-                                                for k in keychoices])
-                    # currentkey = np.random.choice(keychoices, p=(keychoice_probs / keychoice_probs.sum()))
-                    # print([key_center_distance(tonic, k) for k in keychoices])
-                    # print(keychoices)
-
-                    # currentkey = random.choice([mediant.lower(), submediant.lower(),
-                    #                             notes.diminish(mediant), notes.diminish(submediant),
-                    #                             mediant, submediant])
-                # augmented: (1, 3, 5 major)
-                else:
-                    keychoices = [mediant, submediant, notes.augment(dominant)]
-                    keychoice_probs = np.array([modprob_by_keydist[key_center_distance(startingkey,
-                                                                                       resolve_key_signature(k))]
-                                                for k in keychoices])
-                    # currentkey = np.random.choice(keychoices, p=(keychoice_probs / keychoice_probs.sum()))
-            else:
-                # minor: (VI > III) > (#vi > #iii) > (vi > iii)
-                if intervals.perfect_fifth(prevchord[0]) == prevchord[2]:
-                    keychoices = [notes.diminish(mediant), notes.diminish(submediant),
-                                  mediant.lower(), submediant.lower(),
-                                  notes.diminish(mediant).lower(), notes.diminish(submediant).lower()]
-                    keychoice_probs = np.array([modprob_by_keydist[key_center_distance(startingkey,
-                                                                                       resolve_key_signature(k))]
-                                                for k in keychoices])
-                    # currentkey = np.random.choice(keychoices, p=(keychoice_probs / keychoice_probs.sum()))
-                    # print([key_center_distance(tonic, k) for k in keychoices])
-                    # print(keychoices)
-
-                    # currentkey = random.choice([notes.diminish(mediant), notes.diminish(submediant),
-                    #                             mediant.lower(), submediant.lower(),
-                    #                             notes.diminish(mediant).lower(), notes.diminish(submediant).lower()])
-                # diminished: (1, 3, 5, 7 minor)
-                else:
-                    keychoices = [x.lower() for x in prevchord[:2]]
-                    keychoice_probs = np.array([modprob_by_keydist[key_center_distance(startingkey,
-                                                                                       resolve_key_signature(k))]
-                                                for k in keychoices])
-            currentkey = np.random.choice(keychoices, p=(keychoice_probs / keychoice_probs.sum()))
-            nextchord_roman_numeral = 0
-
-        currentkey = resolve_key_signature(currentkey)
-        currentkey_is_major = currentkey[0].isupper()
-        nextchord = ((MAJOR_DIATONIC_CHORDS if currentkey_is_major else MINOR_DIATONIC_CHORDS)
-                     [nextchord_roman_numeral](keys.get_notes(currentkey)[nextchord_roman_numeral]))
-        if (not currentkey_is_major) and (random.random() <= functionalharmony_factor):
-            if nextchord_roman_numeral == 4:
-                nextchord = chords.dominant_seventh(keys.get_notes(currentkey)[4])
-            elif nextchord_roman_numeral == 6:
-                nextchord = chords.diminished_seventh(notes.augment(keys.get_notes(currentkey)[6]))
-
-        # Randomly augment dominant chords:
-        if ((nextchord_roman_numeral == 4)
-                and (intervals.major_third(prevchord[0]) == prevchord[1])
-                and (random.random() > diatonicity_factor)):
-            # print('Augmented chord')
-            nextchord = nextchord[:2] + [notes.augment(nextchord[2])] + nextchord[3:]
-
-        # TODO: maybe a part purely meant for adding "spice" (augmenting random major chords, mode/quality mixture, etc)
-        # Randomly change the current chord:
-        if random.random() > (diatonicity_factor + functionalharmony_factor):
-            # choose randomly selected key based on tonic distance from last chord?
-            # keychoices = [k for x in range(12) if (((k := notes.int_to_note(x)) not in keys_throughout_progression)
-            #                                        and (intervals.major_sixth(k).lower()
-            #                                             not in keys_throughout_progression))]
-            # print(keychoices)
-            # keychoice_probs = np.array([modprob_by_keydist[key_center_distance(keys_throughout_progression[0],
-            #                                                                    resolve_key_signature(k))]
-            #                             for k in keychoices])
-            # print(keys_throughout_progression)
-            # currentkey = np.random.choice(keychoices, p=(keychoice_probs / keychoice_probs.sum()))
-            # if random.random() < 0.5:
-            #     currentkey = intervals.major_sixth(currentkey).lower()
-            currentkey = random.choice([notes.int_to_note(x) for x in range(12)])
-            if random.random() < 0.5:
-                currentkey = currentkey.lower()
-            currentkey = resolve_key_signature(currentkey)
-            nextchord_roman_numeral = 0
-            nextchord = chords.I(currentkey)
-
-        keys_throughout_progression = [currentkey] + keys_throughout_progression  # !!! REPLACE CURRENTKEY EVENTUALLY
-        roman_numerals_throughout_progression = [nextchord_roman_numeral] + roman_numerals_throughout_progression
-        progression = [nextchord] + progression
-
-    progression = [progression[-1]] + progression[:-1]
+
+def generatechords(diatonicity_factor: float = 0.56,
+                   functionalharmony_factor: float = 0.72,
+                   numbars: int = 4,
+                   return_functional_analysis: bool = True,
+                   seed: int | np.random.Generator | None = None) \
+        -> list[Chord] | tuple[list[Chord], list[str], list[int]]:
+    progression, keys_throughout_progression, roman_numerals_throughout_progression = _generatechords(
+        _draws(seed), diatonicity_factor, functionalharmony_factor, numbars,
+        modulation_probabilities(diatonicity_factor))
     return (progression if not return_functional_analysis else
-            (progression,
-             [keys_throughout_progression[-1]] + keys_throughout_progression[:-1],
-             [roman_numerals_throughout_progression[-1]] + roman_numerals_throughout_progression[:-1]))
+            (progression, keys_throughout_progression, roman_numerals_throughout_progression))
+
+
+def _generatechords(draws: Draws,
+                    diatonicity_factor: float,
+                    functionalharmony_factor: float,
+                    numbars: int,
+                    modprob_by_keydist: np.ndarray) -> tuple[list[Chord], list[str], list[int]]:
+    progression, keys_throughout_progression, roman_numerals_throughout_progression = map(list, zip(*_iter_bars(
+        draws, diatonicity_factor, functionalharmony_factor, numbars, modprob_by_keydist)))
+
+    # Each new chord leads into the one generated before it, so the progression is built back to front, and played
+    # starting from the tonic it was built from:
+    return ([progression[0]] + progression[:0:-1],
+            [keys_throughout_progression[0]] + keys_throughout_progression[:0:-1],
+            [roman_numerals_throughout_progression[0]] + roman_numerals_throughout_progression[:0:-1])
+
+
+# Yields a progression's bars as (chord, key, roman numeral), one at a time and endlessly if numbars is None. Since
+# every bar is generated to lead into the one before it, bars are generated a phrase (of up to phrase_bars) at a time
+# and yielded in the order they're played, like generatechords() returns them. Every phrase starts from the tonic of the
+# same key, which the last bar of the phrase before it leads into. Only one phrase is kept around at a time. A bar the
+# generator raises on is redrawn, rather than throwing out the whole phrase (see MAX_BAR_REDRAWS):
+def generatechords_iter(diatonicity_factor: float = 0.56,
+                        functionalharmony_factor: float = 0.72,
+                        numbars: int | None = None,
+                        seed: int | np.random.Generator | None = None,
+                        phrase_bars: int = PHRASE_BARS) -> Iterator[tuple[Chord, str, int]]:
+    draws = _draws(seed)
+    modprob_by_keydist = modulation_probabilities(diatonicity_factor)
+    startingkey = None
+    remaining = numbars
+    while (remaining is None) or (remaining > 0):
+        phrase = list(_iter_bars(draws, diatonicity_factor, functionalharmony_factor,
+                                 phrase_bars if remaining is None else min(phrase_bars, remaining),
+                                 modprob_by_keydist, max_redraws=MAX_BAR_REDRAWS, startingkey=startingkey))
+        startingkey = phrase[0][1]
+        yield phrase[0]
+        yield from reversed(phrase[1:])
+        if remaining is not None:
+            remaining -= len(phrase)
+
+
+def _iter_bars(draws: Draws,
+               diatonicity_factor: float,
+               functionalharmony_factor: float,
+               numbars: int | None,
+               modprob_by_keydist: np.ndarray,
+               max_redraws: int = 0,
+               startingkey: str | None = None) -> Iterator[tuple[Chord, str, int]]:
+    if startingkey is None:
+        startingkey = pick_startingkey(draws)
+    bar = (tonic_triad(startingkey), startingkey, 0)
+    yield bar
+    for barnumber in (itertools.count(1) if numbars is None else range(1, numbars)):
+        for _ in range(max_redraws + 1):
+            try:
+                bar = pick_nextbar(draws, startingkey, *bar, barnumber == 1,
+                                   diatonicity_factor, functionalharmony_factor, modprob_by_keydist)
+                break
+            except GENERATION_ERRORS as e:
+                if not max_redraws:
+                    raise
+                METRICS.count('ohmychord_bar_redraws_total', exception=type(e).__name__)
+        else:
+            # Some bars can't be followed at all (e.g. ones in keys mingus can't spell), so jump to a new tonic:
+            bar = pick_random_tonic(draws)
+        yield bar
+
 
+# Randomly selects the key the progression is in:
+def pick_startingkey(draws: Draws) -> str:
+    startingkey = PITCH_CLASS_NAMES[draws.randbelow(12)]
+    if draws.chance(0.5):
+        startingkey = startingkey.lower()
+    return resolve_key_signature(startingkey)
+
+
+# Picks the chord leading into prevchord (and the key and roman numeral it's analyzed in):
+def pick_nextbar(draws: Draws,
+                 startingkey: str,
+                 prevchord: Chord,
+                 prevkey: str,
+                 prev_roman_numeral: int,
+                 is_second_bar: bool,
+                 diatonicity_factor: float,
+                 functionalharmony_factor: float,
+                 modprob_by_keydist: np.ndarray) -> tuple[Chord, str, int]:
+    nextbar = pick_harmonic_motion(draws, startingkey, prevchord, prevkey, prev_roman_numeral, is_second_bar,
+                                   diatonicity_factor, functionalharmony_factor, modprob_by_keydist)
+
+    # TODO: maybe a part purely meant for adding "spice" (augmenting random major chords, mode/quality mixture, etc)
+    # Randomly change the current chord:
+    if not draws.chance(diatonicity_factor + functionalharmony_factor):
+        nextbar = pick_random_tonic(draws)
+    return nextbar
+
+
+# Picks the chord leading into prevchord by functional harmony or voice-leading:
+def pick_harmonic_motion(draws: Draws,
+                         startingkey: str,
+                         prevchord: Chord,
+                         prevkey: str,
+                         prev_roman_numeral: int,
+                         is_second_bar: bool,
+                         diatonicity_factor: float,
+                         functionalharmony_factor: float,
+                         modprob_by_keydist: np.ndarray) -> tuple[Chord, str, int]:
+    currentkey = startingkey if draws.chance(diatonicity_factor) else prevkey
+    currentkey = resolve_key_signature(currentkey)
+
+    # TODO: penalize circle-of-fifths distance of a (ANY) modulation from the starting key based on diatonicity_factor
+    # penalize diatonic deviations based on how long it's been since the last one and how long that one went on for
+    currchord_can_be_tonic = prevchord.has_perfect_fifth
+    temp_currentkey = prevchord[0]
+    if prevchord.has_minor_third:
+        temp_currentkey = temp_currentkey.lower()
+
+    if ((not draws.chance(modprob_by_keydist[key_center_distance(startingkey, temp_currentkey)]))
+            and (currentkey == prevkey)):
+        # Strictly diatonic functional harmony (tonics, predominants, and dominants all in the same key):
+        nextchord_roman_numeral = (prev_roman_numeral + (4 if draws.chance(functionalharmony_factor) else 6)) % 7
+        # Plagal cadences:
+        if is_second_bar and (not draws.chance(functionalharmony_factor)):
+            nextchord_roman_numeral = 3
+    elif draws.chance(functionalharmony_factor) and currchord_can_be_tonic:
+        # Functional harmony, but allowed to assume secondary key centers:
+        currentkey = temp_currentkey
+
+        # deceptive cadences to III and VI:
+        temp_currentkey = key_scale(currentkey)[mediantkey := (0 if (currentkey[0].isupper()
+                                                                     and prevchord.has_minor_seventh)
+                                                               else (0, 2, 5)[draws.randbelow(3)])]
+        if (currentkey != temp_currentkey) and currentkey[0].isupper():
+            currentkey = temp_currentkey.lower()
+
+        nextchord_roman_numeral = 4 if (draws.chance(functionalharmony_factor) or (mediantkey == 5)) else 6
 
-def process_roman_numeral_analysis(chords_: list[list[str]],
+    else:
+        # Voice-leading based on common tones and intervallic distance between chords:
+        keychoices = voice_leading_keychoices(prevchord)
+        keychoice_probs = np.array([modprob_by_keydist[key_center_distance(startingkey, k)] for k in keychoices])
+        currentkey = keychoices[draws.weighted(keychoice_probs / keychoice_probs.sum())]
+        nextchord_roman_numeral = 0
+
+    currentkey = resolve_key_signature(currentkey)
+    currentkey_is_major = currentkey[0].isupper()
+    nextchord = key_chords(currentkey)[nextchord_roman_numeral]
+    if (not currentkey_is_major) and draws.chance(functionalharmony_factor):
+        if nextchord_roman_numeral in (4, 6):
+            nextchord = HARMONIC_MINOR_CHORDS[currentkey][nextchord_roman_numeral]
+
+    # Randomly augment dominant chords:
+    if ((nextchord_roman_numeral == 4)
+            and prevchord.is_major
+            and (not draws.chance(diatonicity_factor))):
+        nextchord = augment_fifth(nextchord)
+
+    return nextchord, currentkey, nextchord_roman_numeral
+
+
+# Jumps to the tonic of a randomly selected key:
+def pick_random_tonic(draws: Draws) -> tuple[Chord, str, int]:
+    # choose randomly selected key based on tonic distance from last chord?
+    currentkey = PITCH_CLASS_NAMES[draws.randbelow(12)]
+    if draws.chance(0.5):
+        currentkey = currentkey.lower()
+    currentkey = resolve_key_signature(currentkey)
+    return tonic_triad(currentkey), currentkey, 0
+
+
+# Generates n progressions at once from one NumPy generator (or seed), with the generator compiled into transition
+# tables for the slider factors. Progressions come out like the ones generatechords() returns when it doesn't raise,
+# but in one pass, without throwing any out (see CompiledSampler.sample_batch(), and profiler.py --check-batch, which
+# compares the two). Returns them as a batch Progression, of (n, numbars) arrays of chord ids, key ids and roman
+# numerals:
+def generatechords_batch(n: int,
+                         diatonicity_factor: float = 0.56,
+                         functionalharmony_factor: float = 0.72,
+                         numbars: int = 4,
+                         seed: int | np.random.Generator | None = None) -> Progression:
+    from chordsampler import compiled_sampler  # chordsampler compiles this module's generator, so it imports it
+    rng = np.random.default_rng(seed)
+    sampler = compiled_sampler(diatonicity_factor, functionalharmony_factor)
+    # Progressions are sampled in chunks to bound memory for very large batches:
+    chunks = [sampler.sample_batch(rng, min(BATCH_CHUNK_SIZE, n - chunk_start), numbars)
+              for chunk_start in range(0, n, BATCH_CHUNK_SIZE)] or [sampler.sample_batch(rng, 0, numbars)]
+    chord_ids, key_ids, numerals = zip(*chunks)
+    return Progression(np.concatenate(chord_ids), np.concatenate(key_ids), np.concatenate(numerals))
+
+
+def process_roman_numeral_analysis(chords_: list[Chord],
                                    keys_: list[str],
                                    numerals: list[int]) -> (list[str], list[str]):
-    roman_numeral_analysis = []
-    startingchord = chords_[0]
-    startingkey = chords_[0][0][0].upper() + chords_[0][0][1:]
-    for currentchord, currentkey, numeral in zip(chords_, keys_, numerals):
-        # print(f'chord: {currentchord}, {numeral}/{currentkey}')
-        roman_numeral_str = ''
-        currentchord_is_major = intervals.major_third(currentchord[0]) == currentchord[1]
-        resetkey = False
-        if numeral == 0:
-            interval_with_startingkey = intervals.determine(startingkey, currentchord[0], shorthand=True)
-            # if (intervals.minor_third(startingchord[0]) == startingchord[1]) and
-            if ((intervals.minor_third(startingchord[0]) == startingchord[1])
-                    and (currentchord[0] not in keys.get_notes(keys_[0]))):
-                if interval_with_startingkey[0] in ('#', 'b'):
-                    roman_numeral_str += interval_with_startingkey[:-1]
-                else:
-                    roman_numeral_str += f'#{interval_with_startingkey[:-1]}'
-            elif ((intervals.major_third(startingchord[0]) == startingchord[1])
-                  and (len(interval_with_startingkey) > 1)):
-                roman_numeral_str += interval_with_startingkey[:-1]
-            print(interval_with_startingkey)
-            numeral = int(interval_with_startingkey[-1]) - 1
-            resetkey = True
-        # Convert integer to Roman numeral
-        if numeral < 3:
-            roman_numeral_str += 'I' * (numeral + 1)
-        elif numeral == 3:
-            roman_numeral_str += 'IV'
-        elif numeral >= 4:
-            roman_numeral_str += 'V' + (((numeral + 1) % 5) * 'I')
-        else:
-            raise ValueError('Invalid Roman numerals')
-        if not currentchord_is_major:
-            roman_numeral_str = roman_numeral_str.lower()
-        if intervals.minor_fifth(currentchord[0]) == currentchord[2]:
-            roman_numeral_str += ('ø'
-                                  if ((len(currentchord) > 3)
-                                      and (intervals.minor_seventh(currentchord[0]) == currentchord[3]))
-                                  else '°')
-        elif intervals.major_fifth(currentchord[0]) != currentchord[2]:
-            roman_numeral_str += '+'
-        if len(currentchord) == 4:
-            roman_numeral_str += '7'
-        print(f'chord: {currentchord}, {roman_numeral_str}/{keys_[0] if resetkey else currentkey}')
-        roman_numeral_analysis.append(replace_flat_and_sharp_symbols(f'{roman_numeral_str}'
-                                                                     f'/{keys_[0] if resetkey else currentkey}',
-                                                                     is_roman_numeral=True))
+    return list(process_roman_numeral_analysis_iter(zip(chords_, keys_, numerals)))
+
+
+# Analyzes a stream of bars (as generatechords_iter() yields them) one at a time. The first bar is taken to be the
+# tonic the progression is in:
+def process_roman_numeral_analysis_iter(bars: Iterable[tuple[Chord, str, int]]) -> Iterator[str]:
+    bars = iter(bars)
+    try:
+        startingchord, startingkeysig, _ = firstbar = next(bars)
+    except StopIteration:
+        return
+    for currentchord, currentkey, numeral in itertools.chain((firstbar,), bars):
+        yield analyze_bar(startingchord, startingkeysig, currentchord, currentkey, numeral)
 
     # print(chords_)
     # print(keys)
     # print(numerals)
     # print([intervals.determine(k[0].upper() + k[1:], c[0], shorthand=True) for c, k in zip(chords_, keys)])
-    return roman_numeral_analysis
+
+
+# Roman numeral analysis of one bar of a progression that starts on startingchord, in startingkeysig, as the page
+# shows it:
+def analyze_bar(startingchord: Chord, startingkeysig: str, currentchord: Chord, currentkey: str, numeral: int) -> str:
+    return roman_numeral_symbol(analyze_bar_shorthand(startingchord, startingkeysig, currentchord, currentkey, numeral))
+
+
+# The same analysis in plain text, with the key as mingus spells it (e.g. 'viiø7/bb'):
+def analyze_bar_shorthand(startingchord: Chord, startingkeysig: str, currentchord: Chord, currentkey: str,
+                          numeral: int) -> str:
+    startingkey = startingchord[0][0].upper() + startingchord[0][1:]
+    # print(f'chord: {currentchord}, {numeral}/{currentkey}')
+    roman_numeral_str = ''
+    resetkey = False
+    if numeral == 0:
+        interval_with_startingkey = interval_shorthand(startingkey, currentchord[0])
+        if (startingchord.has_minor_third
+                and (currentchord[0] not in key_scale(startingkeysig))):
+            if interval_with_startingkey[0] in ('#', 'b'):
+                roman_numeral_str += interval_with_startingkey[:-1]
+            else:
+                roman_numeral_str += f'#{interval_with_startingkey[:-1]}'
+        elif (startingchord.is_major
+              and (len(interval_with_startingkey) > 1)):
+            roman_numeral_str += interval_with_startingkey[:-1]
+        logger.debug('%s', interval_with_startingkey)
+        numeral = int(interval_with_startingkey[-1]) - 1
+        resetkey = True
+    # Convert integer to Roman numeral
+    if numeral < 3:
+        roman_numeral_str += 'I' * (numeral + 1)
+    elif numeral == 3:
+        roman_numeral_str += 'IV'
+    elif numeral >= 4:
+        roman_numeral_str += 'V' + (((numeral + 1) % 5) * 'I')
+    else:
+        raise ValueError('Invalid Roman numerals')
+    if not currentchord.is_major:
+        roman_numeral_str = roman_numeral_str.lower()
+    if currentchord.has_diminished_fifth:
+        roman_numeral_str += 'ø' if currentchord.has_minor_seventh else '°'
+    elif not currentchord.has_perfect_fifth:
+        roman_numeral_str += '+'
+    if len(currentchord) == 4:
+        roman_numeral_str += '7'
+    logger.debug('chord: %s, %s/%s', currentchord, roman_numeral_str, startingkeysig if resetkey else currentkey)
+    return f'{roman_numeral_str}/{startingkeysig if resetkey else currentkey}'
+
+
+# Roman numeral analyses as the page shows them, by their plain text:
+ROMAN_NUMERAL_SYMBOLS = {}
+
+
+def roman_numeral_symbol(shorthand: str) -> str:
+    if shorthand not in ROMAN_NUMERAL_SYMBOLS:
+        ROMAN_NUMERAL_SYMBOLS[shorthand] = replace_flat_and_sharp_symbols(shorthand, is_roman_numeral=True)
+    return ROMAN_NUMERAL_SYMBOLS[shorthand]
 
 
 def replace_flat_and_sharp_symbols(s: str, is_roman_numeral: bool = False) -> str:
@@ -305,43 +464,73 @@ def replace_flat_and_sharp_symbols(s: str, is_roman_numeral: bool = False) -> st
     return s.translate(str.maketrans({'b': '♭', '#': '♯', '7': '<sup>7</sup>', 'ø': '<sup>ø</sup>'}))
 
 
-def chords_to_chordsymbols(chords_: list[list[str]]) -> list[str]:
+def _chord_shorthand(chord: Chord) -> str | None:
     try:
-        return [replace_flat_and_sharp_symbols(chords.determine(chord, shorthand=True, no_inversions=True)[0])
-                for chord in chords_]
+        return chords.determine(list(chord), shorthand=True, no_inversions=True)[0]
     except IndexError:
-        print(chords_)
-
-
-def chords_to_midi(chords_: list[list[str]], path: str = './static'):
-    # Outputting audio playback of the generated chord progression:
-    track = 0
-    channel = 0
-    time = 0  # In beats
-    duration = 4  # In beats
-    tempo = 120  # In BPM
-    volume = 72  # 0-127, as per the MIDI standard
-
-    midioutput = MIDIFile(4)
-    midioutput.addTempo(0, time, tempo)
-    midioutput.addTempo(1, time, tempo)
-    midioutput.addTempo(2, time, tempo)
-    midioutput.addTempo(3, time, tempo)
-    for i, chord in enumerate(chords_):
-        midioutput.addNote(0, channel, 36 + notes.note_to_int(chord[0]), time + (duration * i), duration - 0.1, volume=volume)
-        midioutput.addNote(0, channel, 48 + notes.note_to_int(chord[0]), time + (duration * i), duration - 0.1,
-                           volume=volume)
-        for j, pitch in enumerate(chord):
-            midioutput.addNote(0, channel, 60 + notes.note_to_int(pitch), time + (duration * i), duration - 0.1, volume=volume)
-
-    patchid = random.randint(0, 128)
-    print(patchid)
-    # patchid = 81, 95
-    patchid = 90
-    midioutput.addProgramChange(0, channel, 0, patchid)
-    # midioutput.addProgramChange(1, channel, 0, patchid)
-    # midioutput.addProgramChange(2, channel, 0, patchid)
-    # midioutput.addProgramChange(3, channel, 0, patchid)
+        return None
+
+
+# Chord name of every chord the generator can produce, in plain text as mingus names it (e.g. 'AbM7'), or None for
+# chords mingus can't name:
+CHORD_SHORTHANDS = {c: _chord_shorthand(c) for c in CHORDS}
 
+
+def chord_shorthand(chord: Chord) -> str | None:
+    if chord not in CHORD_SHORTHANDS:
+        CHORD_SHORTHANDS[chord] = _chord_shorthand(chord)
+    return CHORD_SHORTHANDS[chord]
+
+
+def chords_to_chordshorthands(chords_: list[Chord]) -> list[str | None]:
+    return [chord_shorthand(chord) for chord in chords_]
+
+
+def _chord_symbol(chord: Chord) -> str | None:
+    shorthand = chord_shorthand(chord)
+    return replace_flat_and_sharp_symbols(shorthand) if shorthand is not None else None
+
+
+# Chord symbol of every chord the generator can produce (None for chords mingus can't name):
+CHORD_SYMBOLS = {c: _chord_symbol(c) for c in CHORDS}
+
+
+def chord_symbol(chord: Chord) -> str | None:
+    if chord not in CHORD_SYMBOLS:
+        CHORD_SYMBOLS[chord] = _chord_symbol(chord)
+    return CHORD_SYMBOLS[chord]
+
+
+# Chord symbols of a stream of chords, one at a time (None for chords mingus can't name):
+def chords_to_chordsymbols_iter(chords_: Iterable[Chord]) -> Iterator[str | None]:
+    return map(chord_symbol, chords_)
+
+
+def chords_to_chordsymbols(chords_: list[Chord]) -> list[str]:
+    chordsymbols = [chord_symbol(chord) for chord in chords_]
+    if None in chordsymbols:
+        logger.debug('unnamed chord in %s', chords_)
+        return None
+    return chordsymbols
+
+
+def chords_to_midi(chords_: list[Chord], path: str = './static'):
     with open(f'{path}/sample-chord-progression.mid', 'wb') as outputfile:
-        midioutput.writeFile(outputfile)
+        outputfile.write(chords_to_midi_bytes(chords_))
+
+
+# Renders a progression's MIDI in memory:
+def chords_to_midi_bytes(chords_: Iterable[Chord]) -> bytes:
+    return voicings_to_midi_bytes((chord.root, chord.mask) for chord in chords_)
+
+
+# Renders MIDI for bars given by their root and pitch classes (as a 12-bit mask), which is all of a chord that its
+# MIDI depends on:
+def voicings_to_midi_bytes(voicings: Iterable[tuple[int, int]]) -> bytes:
+    return encode_smf(voicings)
+
+
+# Renders many progressions into one MIDI file, each on its own track or one after another on a single track:
+def chords_to_midi_batch_bytes(progressions: Iterable[Iterable[Chord]], back_to_back: bool = False) -> bytes:
+    return encode_smf_batch(([(chord.root, chord.mask) for chord in chords_] for chords_ in progressions),
+                            back_to_back=back_to_back)
@@ -0,0 +1,374 @@
+from bisect import bisect_right
+from chordtypes import Chord, key_id
+from chordgenerator import (GENERATION_ERRORS, pick_startingkey, pick_harmonic_motion, pick_random_tonic,
+                            modulation_probabilities, analyze_bar_shorthand, chord_symbol)
+from theorytables import tonic_triad
+from typing import Callable, NamedTuple
+import math
+import threading
+import numpy as np
+
+# Target of the transitions on which the generator raises (and the progression has to be thrown out):
+FAILED = -1
+
+# Largest change in scaled survival (see CompiledSampler._get_survival()) from one bar to the next at which it's taken
+# to have stopped changing:
+SURVIVAL_TOLERANCE = 1e-14
+
+
+# Stands in for the generator's source of random decisions (see chordgenerator.Draws), but instead of drawing, replays
+# a script of earlier decisions and takes the first possible outcome of every decision after them, keeping track of the
+# alternatives:
+class _EnumeratingDraws:
+    __slots__ = ('script', 'path', 'probability', 'alternatives')
+
+    def __init__(self, script: list[int]):
+        self.script = script
+        self.path = []
+        self.probability = 1.0
+        self.alternatives = []
+
+    def _decide(self, probabilities: list[float]) -> int:
+        if len(self.path) < len(self.script):
+            decision = self.script[len(self.path)]
+        else:
+            outcomes = [i for i, p in enumerate(probabilities) if p > 0]
+            decision = outcomes[0]
+            self.alternatives += [self.path + [i] for i in outcomes[1:]]
+        self.path.append(decision)
+        self.probability *= probabilities[decision]
+        return decision
+
+    def chance(self, p: float) -> bool:
+        p = min(max(p, 0), 1)
+        return self._decide([1 - p, p]) == 1
+
+    def randbelow(self, n: int) -> int:
+        return self._decide([1 / n] * n)
+
+    def weighted(self, p: np.ndarray) -> int:
+        return self._decide(p.tolist())
+
+
+# Every outcome of one of the generator's random steps, with its probability (outcomes on which the step raises are
+# collected under None, along with the exception):
+def _enumerate_outcomes(step: Callable) -> tuple[dict, Exception | None]:
+    outcomes = {}
+    error = None
+    scripts = [[]]
+    while scripts:
+        draws = _EnumeratingDraws(scripts.pop())
+        try:
+            outcome = step(draws)
+        except GENERATION_ERRORS as e:
+            outcome = None
+            error = e
+        scripts += draws.alternatives
+        outcomes[outcome] = outcomes.get(outcome, 0) + draws.probability
+    return outcomes, error
+
+
+# A progression from sample_valid(), along with its analysis and how many draws it took:
+class ValidProgression(NamedTuple):
+    chords: list[Chord]
+    keys: list[str]
+    numerals: list[int]
+    analysis: list[str]
+    draws: int
+
+
+# The generator, compiled into a Markov chain for one pair of slider factors. A state is the bar last generated
+# (startingkey, chord, key, roman numeral, and whether it's the first bar), and each state's transitions are worked
+# out by enumerating every path through pick_nextbar() the first time the state is reached. After that, each bar
+# only takes a single draw from the state's cumulative transition probabilities.
+# pick_nextbar()'s random jumps to a new tonic don't depend on the state, so they're enumerated once and mixed into
+# every state's harmonic motion, rather than enumerated again after every path through it:
+class CompiledSampler:
+    def __init__(self, diatonicity_factor: float, functionalharmony_factor: float):
+        self.diatonicity_factor = diatonicity_factor
+        self.functionalharmony_factor = functionalharmony_factor
+        self.modprob_by_keydist = modulation_probabilities(diatonicity_factor)
+        self.random_tonic_probability = 1 - min(max(diatonicity_factor + functionalharmony_factor, 0), 1)
+        self.random_tonics, _ = _enumerate_outcomes(pick_random_tonic)
+
+        self.states = []
+        self._state_ids = {}
+        self.cumulative = []  # Cumulative transition probabilities of every state, or None until it's compiled
+        self.targets = []
+        self.errors = []  # Exception raised on a state's FAILED transition, as (type, args)
+        self.analyses = []  # Plain text analysis of every state's bar, or None until it's analyzed (see _analyze())
+        self.valid_cumulative = []  # Transitions to bars that can be analyzed and named, or None until compiled
+        self.valid_targets = []
+        self._lock = threading.Lock()
+        self._tables = None
+        self._survival = []  # See _get_survival()
+        self._survival_scales = []
+        self._survival_converged = False
+
+        startingkeys, _ = _enumerate_outcomes(pick_startingkey)
+        self.start_targets = [self._state_id((k, tonic_triad(k), k, 0, True)) for k in startingkeys]
+        self.start_cumulative = _cumulative(list(startingkeys.values()))
+        self.valid_start_targets, self.valid_start_cumulative = self._valid_transitions(
+            zip(self.start_targets, startingkeys.values()))
+
+    # Samplers are pickled with every state compiled so far (see tablecache), but without their lock or the tables
+    # sample_batch() works out from them:
+    def __getstate__(self) -> dict:
+        return {name: value for name, value in self.__dict__.items()
+                if name not in ('_lock', '_tables', '_survival', '_survival_scales', '_survival_converged')}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._tables = None
+        self._survival = []
+        self._survival_scales = []
+        self._survival_converged = False
+
+    def _state_id(self, state: tuple[str, Chord, str, int, bool]) -> int:
+        if state not in self._state_ids:
+            self._state_ids[state] = len(self.states)
+            self.states.append(state)
+            self.cumulative.append(None)
+            self.targets.append(None)
+            self.errors.append(None)
+            self.analyses.append(None)
+            self.valid_cumulative.append(None)
+            self.valid_targets.append(None)
+        return self._state_ids[state]
+
+    def _compile(self, state_id: int):
+        with self._lock:
+            if self.cumulative[state_id] is not None:
+                return
+            startingkey, prevchord, prevkey, prev_roman_numeral, is_first_bar = self.states[state_id]
+            outcomes, error = _enumerate_outcomes(
+                lambda draws: pick_harmonic_motion(draws, startingkey, prevchord, prevkey, prev_roman_numeral,
+                                                   is_first_bar, self.diatonicity_factor,
+                                                   self.functionalharmony_factor, self.modprob_by_keydist))
+            if self.random_tonic_probability > 0:
+                success_probability = 1 - outcomes.get(None, 0)
+                outcomes = {outcome: (p if outcome is None else p * (1 - self.random_tonic_probability))
+                            for outcome, p in outcomes.items()}
+                for outcome, p in self.random_tonics.items():
+                    outcomes[outcome] = (outcomes.get(outcome, 0)
+                                         + (success_probability * self.random_tonic_probability * p))
+            self.targets[state_id] = [FAILED if outcome is None else
+                                      self._state_id((startingkey, outcome[0], outcome[1], outcome[2], False))
+                                      for outcome in outcomes]
+            self.errors[state_id] = (type(error), error.args) if error is not None else None
+            self.valid_targets[state_id], self.valid_cumulative[state_id] = self._valid_transitions(
+                zip(self.targets[state_id], outcomes.values()))
+            self.cumulative[state_id] = _cumulative(list(outcomes.values()))
+
+    # Drops transitions the generator raises on or that lead to bars that can't be analyzed or named:
+    def _valid_transitions(self, transitions) -> tuple[list[int], list[float] | None]:
+        transitions = [(target, p) for target, p in transitions
+                       if (p > 0) and (target != FAILED) and self._analyze(target)]
+        if not transitions:
+            return [], None
+        return [target for target, _ in transitions], _cumulative([p for _, p in transitions])
+
+    # Analysis of a state's bar (see analyze_bar_shorthand()), or '' if it can't be analyzed or its chord can't be
+    # named:
+    def _analyze(self, state_id: int) -> str:
+        if self.analyses[state_id] is None:
+            startingkey, chord, key, numeral, _ = self.states[state_id]
+            try:
+                analysis = analyze_bar_shorthand(tonic_triad(startingkey), startingkey, chord, key, numeral)
+            except GENERATION_ERRORS:
+                analysis = ''
+            self.analyses[state_id] = analysis if chord_symbol(chord) is not None else ''
+        return self.analyses[state_id]
+
+    # Compiles every state reachable from the starting keys, rather than as they're reached:
+    def compile_all(self):
+        reached = set(self.start_targets)
+        unvisited = list(reached)
+        while unvisited:
+            state_id = unvisited.pop()
+            if self.cumulative[state_id] is None:
+                self._compile(state_id)
+            for target in self.targets[state_id]:
+                if (target != FAILED) and (target not in reached):
+                    reached.add(target)
+                    unvisited.append(target)
+
+    def _transition(self, state_id: int, u: float) -> int:
+        if self.cumulative[state_id] is None:
+            self._compile(state_id)
+        target = self.targets[state_id][bisect_right(self.cumulative[state_id], u)]
+        if target == FAILED:
+            error_type, error_args = self.errors[state_id]
+            raise error_type(*error_args)
+        return target
+
+    # Samples one progression, in the same form generatechords() returns it (raising whenever it would):
+    def sample(self, rng: np.random.Generator, numbars: int) -> tuple[list[Chord], list[str], list[int]]:
+        uniforms = rng.random(numbars).tolist()
+        state_id = self.start_targets[bisect_right(self.start_cumulative, uniforms[0])]
+        states = [self.states[state_id]]
+        for u in uniforms[1:]:
+            state_id = self._transition(state_id, u)
+            states.append(self.states[state_id])
+        states = [states[0]] + states[:0:-1]
+        return [s[1] for s in states], [s[2] for s in states], [s[3] for s in states]
+
+    # Samples one progression that can be analyzed and named all the way through, drawing every bar only among the ones
+    # that can be (where rejection sampling throws out whole progressions). Bars that can't be followed by any valid
+    # bar are found as they're reached, backed out of, and not drawn again in the progression except as the last bar.
+    # Dead ends aren't remembered between progressions, so a progression only depends on the draws it's given:
+    def sample_valid(self, rng: np.random.Generator, numbars: int) -> ValidProgression:
+        path = []
+        dead_ends = set()
+        draws = 0
+        while len(path) < numbars:
+            if path:
+                if self.valid_cumulative[path[-1]] is None:
+                    self._compile(path[-1])
+                targets, cumulative = self.valid_targets[path[-1]], self.valid_cumulative[path[-1]]
+            else:
+                targets, cumulative = self.valid_start_targets, self.valid_start_cumulative
+            is_last_bar = len(path) == numbars - 1
+            if targets:
+                draws += 1
+                target = targets[bisect_right(cumulative, rng.random())]
+                if is_last_bar or (target not in dead_ends):
+                    path.append(target)
+                    continue
+                if not dead_ends.issuperset(targets):
+                    continue
+            if not path:
+                raise ValueError('no valid progressions at these slider factors')
+            dead_ends.add(path.pop())
+
+        states = [self.states[state_id] for state_id in path]
+        analyses = [self.analyses[state_id] for state_id in path]
+        states = states[:1] + states[:0:-1]
+        analyses = analyses[:1] + analyses[:0:-1]
+        return ValidProgression([s[1] for s in states], [s[2] for s in states], [s[3] for s in states], analyses,
+                                draws)
+
+    # Samples n progressions at once, a bar at a time across all of them, as generatechords() returns them when it
+    # doesn't raise. Rather than throwing out the progressions it raises on, every bar is drawn in proportion to how
+    # likely it is to be generated times how likely the bars after it are to get through without raising (see
+    # _get_survival()), which comes out the same but takes a single pass. Returns the (n, numbars) arrays of chord ids,
+    # key ids and numerals that generatechords_batch() keeps in a Progression:
+    def sample_batch(self, rng: np.random.Generator, n: int, numbars: int) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        probabilities, targets, components, chord_ids, key_ids, numerals = self._get_tables()
+        state_ids = np.empty((n, numbars), dtype=np.int32)
+        if numbars > 0:
+            survival, scales = self._get_survival(numbars - 1)
+            start_targets = np.array(self.start_targets, dtype=np.int32)
+            start_scales = scales[components[start_targets]]
+            if not np.isfinite(start_scales.max()):
+                raise ValueError(f'no progressions of {numbars} bars at these slider factors')
+            weights = (np.diff(self.start_cumulative, prepend=0.0) * survival[start_targets]
+                       * np.exp(start_scales - start_scales.max()))
+            state_ids[:, 0] = start_targets[_draw(rng, np.broadcast_to(weights, (n, len(weights))))]
+        for bar in range(1, numbars):
+            survival, _ = self._get_survival(numbars - 1 - bar)
+            current = state_ids[:, bar - 1]
+            state_ids[:, bar] = targets[current, _draw(rng, probabilities[current] * survival[targets[current]])]
+
+        state_ids = np.concatenate([state_ids[:, :1], state_ids[:, :0:-1]], axis=1)
+        return chord_ids[state_ids], key_ids[state_ids], numerals[state_ids]
+
+    # Every state's transitions the generator doesn't raise on, padded out into (states, most transitions) arrays of
+    # probabilities and targets, plus each state's component (the index of its starting key, which every state it
+    # leads to shares), chord id, key id and numeral. Built once, with every state compiled:
+    def _get_tables(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        if self._tables is None:
+            self.compile_all()
+            with self._lock:
+                if self._tables is None:
+                    self._tables = self._build_tables()
+        return self._tables
+
+    def _build_tables(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        transitions = [[(target, p) for target, p in zip(targets, np.diff(cumulative, prepend=0.0).tolist())
+                        if (p > 0) and (target != FAILED)] if targets is not None else []
+                       for targets, cumulative in zip(self.targets, self.cumulative)]
+        probabilities = np.zeros((len(self.states), max([1] + [len(t) for t in transitions])))
+        targets = np.zeros(probabilities.shape, dtype=np.int32)
+        for state_id, state_transitions in enumerate(transitions):
+            probabilities[state_id, :len(state_transitions)] = [p for _, p in state_transitions]
+            targets[state_id, :len(state_transitions)] = [target for target, _ in state_transitions]
+        startingkeys = sorted({s[0] for s in self.states})
+        return (probabilities, targets, np.array([startingkeys.index(s[0]) for s in self.states], dtype=np.int16),
+                np.array([s[1].id for s in self.states], dtype=np.int16),
+                np.array([key_id(s[2]) for s in self.states], dtype=np.int16),
+                np.array([s[3] for s in self.states], dtype=np.int8))
+
+    # How likely the generator is to get through the next k bars from every state without raising, as h(k, s) =
+    # sum(p(s, t) * h(k - 1, t)) over s's transitions, with h(0, s) = 1. Only ratios between states with the same
+    # starting key matter to the bars after the first, so every h(k) is kept scaled to the likeliest state of each
+    # starting key (which also keeps it from underflowing), and the log of the scale, by starting key, is returned along
+    # with it. Worked out one more bar at a time as longer batches need them, until the scaled h(k) stops changing:
+    def _get_survival(self, k: int) -> tuple[np.ndarray, np.ndarray]:
+        probabilities, targets, components, _, _, _ = self._get_tables()
+        with self._lock:
+            if not self._survival:
+                self._survival.append(np.ones(len(self.states)))
+                self._survival_scales.append(np.zeros(components.max() + 1))
+            while (len(self._survival) <= k) and not self._survival_converged:
+                survival = (probabilities * self._survival[-1][targets]).sum(axis=1)
+                scale = np.zeros(len(self._survival_scales[-1]))
+                np.maximum.at(scale, components, survival)
+                survival /= np.where(scale > 0, scale, 1)[components]
+                with np.errstate(divide='ignore'):
+                    self._survival_scales.append(self._survival_scales[-1] + np.log(scale))
+                self._survival_converged = np.abs(survival - self._survival[-1]).max() <= SURVIVAL_TOLERANCE
+                self._survival.append(survival)
+            if k < len(self._survival):
+                return self._survival[k], self._survival_scales[k]
+            # Past convergence, h(k) only grows by the same factor every bar:
+            growth = self._survival_scales[-1] - self._survival_scales[-2]
+            with np.errstate(invalid='ignore'):
+                scales = self._survival_scales[-1] + (k - len(self._survival) + 1) * growth
+            return self._survival[-1], np.where(np.isfinite(growth), scales, -math.inf)
+
+
+# Draws an index into every row of weights, in proportion to them:
+def _draw(rng: np.random.Generator, weights: np.ndarray) -> np.ndarray:
+    cumulative = np.cumsum(weights, axis=1)
+    draws = (cumulative <= (rng.random(len(weights)) * cumulative[:, -1])[:, None]).sum(axis=1)
+    return np.minimum(draws, weights.shape[1] - 1)
+
+
+def _cumulative(probabilities: list[float]) -> list[float]:
+    cumulative = np.cumsum(probabilities) / sum(probabilities)
+    cumulative[-1] = 1.0  # Guards against rounding, since draws are in [0, 1)
+    return cumulative.tolist()
+
+
+# Compiled samplers by slider factors (see _sampler_factors()):
+_compiled_samplers = {}
+_compiled_samplers_lock = threading.Lock()
+
+
+# Slider factors as samplers are compiled for and kept by. Factors that only miss a hundredth (the resolution of the
+# randomness slider) by rounding, like the page's 1 - 0.07, are taken to be on it, so that they find the samplers
+# tablecache loaded. Any others are kept as they are, rather than snapped to the nearest hundredth:
+def _sampler_factors(diatonicity_factor: float, functionalharmony_factor: float) -> tuple[float, float]:
+    return _unround(diatonicity_factor), _unround(functionalharmony_factor)
+
+
+def _unround(factor: float) -> float:
+    hundredths = round(factor * 100)
+    return hundredths / 100 if abs((factor * 100) - hundredths) < 1e-9 else factor
+
+
+def compiled_sampler(diatonicity_factor: float, functionalharmony_factor: float) -> CompiledSampler:
+    factors = _sampler_factors(diatonicity_factor, functionalharmony_factor)
+    with _compiled_samplers_lock:
+        if factors not in _compiled_samplers:
+            _compiled_samplers[factors] = CompiledSampler(*factors)
+        return _compiled_samplers[factors]
+
+
+# Makes a sampler compiled elsewhere (e.g. loaded by tablecache) the one compiled_sampler() returns for its factors:
+def install_compiled_sampler(sampler: CompiledSampler):
+    with _compiled_samplers_lock:
+        _compiled_samplers[_sampler_factors(sampler.diatonicity_factor, sampler.functionalharmony_factor)] = sampler
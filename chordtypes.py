@@ -0,0 +1,165 @@
+from mingus.core import notes
+from typing import Sequence
+import numpy as np
+
+# Pitch classes (relative to the root, as a 12-bit mask) of every chord quality seen so far, indexed by quality code:
+QUALITY_MASKS = []
+_quality_codes = {}
+
+# Every chord seen so far, indexed by id (chords are interned, so each spelling only ever has one Chord):
+CHORDS = []
+_chords_by_spelling = {}
+
+# Every key seen so far, indexed by id:
+KEYS = []
+_key_ids = {}
+
+# Every roman numeral analysis (in plain text, see chordgenerator.analyze_bar_shorthand()) seen so far, indexed by id:
+ANALYSES = []
+_analysis_ids = {}
+
+
+class Chord:
+    __slots__ = ('id', 'root', 'quality', 'mask', 'spelling')
+
+    def __init__(self, spelling: tuple[str, ...]):
+        self.id = len(CHORDS)
+        self.root = notes.note_to_int(spelling[0])
+        self.mask = 0
+        quality_mask = 0
+        for note in spelling:
+            self.mask |= 1 << notes.note_to_int(note)
+            quality_mask |= 1 << ((notes.note_to_int(note) - self.root) % 12)
+        if quality_mask not in _quality_codes:
+            _quality_codes[quality_mask] = len(QUALITY_MASKS)
+            QUALITY_MASKS.append(quality_mask)
+        self.quality = _quality_codes[quality_mask]
+        self.spelling = spelling  # Only kept for display (chord symbols, analysis) and for mingus
+
+    # Chords stand in for mingus' lists of note names:
+    def __getitem__(self, index):
+        return self.spelling[index]
+
+    def __len__(self) -> int:
+        return len(self.spelling)
+
+    def __iter__(self):
+        return iter(self.spelling)
+
+    def __repr__(self) -> str:
+        return f'Chord({list(self.spelling)})'
+
+    def __reduce__(self):
+        return intern_chord, (self.spelling,)
+
+    @property
+    def is_major(self) -> bool:  # Major third above the root
+        return bool(QUALITY_MASKS[self.quality] & (1 << 4))
+
+    @property
+    def has_minor_third(self) -> bool:
+        return bool(QUALITY_MASKS[self.quality] & (1 << 3))
+
+    @property
+    def has_perfect_fifth(self) -> bool:
+        return bool(QUALITY_MASKS[self.quality] & (1 << 7))
+
+    @property
+    def has_diminished_fifth(self) -> bool:
+        return bool(QUALITY_MASKS[self.quality] & (1 << 6))
+
+    @property
+    def has_minor_seventh(self) -> bool:
+        return bool(QUALITY_MASKS[self.quality] & (1 << 10))
+
+    @property
+    def pitch_classes(self) -> list[int]:
+        return [pc for pc in range(12) if self.mask & (1 << pc)]
+
+
+# Returns the one Chord with the given spelling (a mingus list of note names):
+def intern_chord(spelling: Sequence[str]) -> Chord:
+    spelling = tuple(spelling)
+    if spelling not in _chords_by_spelling:
+        _chords_by_spelling[spelling] = chord_ = Chord(spelling)
+        CHORDS.append(chord_)
+    return _chords_by_spelling[spelling]
+
+
+def key_id(key: str) -> int:
+    if key not in _key_ids:
+        _key_ids[key] = len(KEYS)
+        KEYS.append(key)
+    return _key_ids[key]
+
+
+
+def analysis_id(analysis: str) -> int:
+    if analysis not in _analysis_ids:
+        _analysis_ids[analysis] = len(ANALYSES)
+        ANALYSES.append(analysis)
+    return _analysis_ids[analysis]
+
+
+# A chord progression and its functional analysis, stored as parallel arrays of chord ids, key ids and numerals (plus,
+# if it has been analyzed, analysis ids). A batch of progressions is stored the same way, as (n, numbars) arrays, and
+# indexing or iterating over it gives its progressions:
+class Progression:
+    __slots__ = ('chords', 'keys', 'numerals', 'analyses')
+
+    def __init__(self, chords: np.ndarray, keys: np.ndarray, numerals: np.ndarray, analyses: np.ndarray | None = None):
+        self.chords = chords
+        self.keys = keys
+        self.numerals = numerals
+        self.analyses = analyses
+
+    @classmethod
+    def from_lists(cls, chords_: Sequence[Chord], keys_: Sequence[str], numerals: Sequence[int],
+                   analyses: Sequence[str] | None = None) -> 'Progression':
+        return cls(np.array([c.id for c in chords_], dtype=np.int16),
+                   np.array([key_id(k) for k in keys_], dtype=np.int16),
+                   np.array(numerals, dtype=np.int8),
+                   None if analyses is None else np.array([analysis_id(a) for a in analyses], dtype=np.int16))
+
+    # Bars in a progression, or progressions in a batch:
+    def __len__(self) -> int:
+        return len(self.chords)
+
+    def __getitem__(self, index) -> 'Progression':
+        return Progression(self.chords[index], self.keys[index], self.numerals[index],
+                           None if self.analyses is None else self.analyses[index])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __reduce__(self):
+        # Ids are only meaningful within one process, so progressions are pickled by spelling:
+        return Progression._from_flat_lists, (self.chords.shape, [CHORDS[i] for i in self.chords.ravel().tolist()],
+                                              [KEYS[i] for i in self.keys.ravel().tolist()],
+                                              self.numerals.ravel().tolist(),
+                                              None if self.analyses is None else
+                                              [ANALYSES[i] for i in self.analyses.ravel().tolist()])
+
+    @classmethod
+    def _from_flat_lists(cls, shape: tuple[int, ...], chords_: list[Chord], keys_: list[str], numerals: list[int],
+                         analyses: list[str] | None) -> 'Progression':
+        progression = cls.from_lists(chords_, keys_, numerals, analyses)
+        return cls(progression.chords.reshape(shape), progression.keys.reshape(shape),
+                   progression.numerals.reshape(shape),
+                   None if analyses is None else progression.analyses.reshape(shape))
+
+    # The lists below are of a single progression's bars:
+    def chord_list(self) -> list[Chord]:
+        return [CHORDS[i] for i in self.chords.tolist()]
+
+    def key_list(self) -> list[str]:
+        return [KEYS[i] for i in self.keys.tolist()]
+
+    def numeral_list(self) -> list[int]:
+        return self.numerals.tolist()
+
+    def analysis_list(self) -> list[str]:
+        return [ANALYSES[i] for i in self.analyses.tolist()]
+
+    def to_lists(self) -> tuple[list[Chord], list[str], list[int]]:
+        return self.chord_list(), self.key_list(), self.numeral_list()
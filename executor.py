@@ -0,0 +1,266 @@
+from concurrent.futures import Future
+from instrumentation import METRICS
+from progressionrenderer import (DEFAULT_RANDOMFACTOR, DRAW_COUNTERS, RenderedProgression, cache_progression,
+                                 render_progression, render_seeded_progression)
+from tablecache import load_tables
+from typing import TYPE_CHECKING
+import logging
+import os
+import threading
+import time
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Processes generation, analysis and rendering are sent to (0 renders everything inline, in the web worker):
+GENERATION_PROCESSES = int(os.environ.get('GENERATION_PROCESSES', 2))
+
+# How long (in milliseconds) a page request waits for its progression before it's served a fallback:
+GENERATION_DEADLINE_MS = float(os.environ.get('GENERATION_DEADLINE_MS', 250))
+
+# How long (in seconds) to hold on to a request so that others arriving meanwhile go to the pool with it, and the most
+# renders, and bars, sent to the pool as one task. Only renders of the same number of bars go in a task together, so
+# that a task of long progressions (e.g. for the API) holds a process for at most about as long as one of them, or
+# MAX_BATCH_BARS of shorter ones (around 15ms):
+BATCH_WINDOW = 0.002
+MAX_BATCH_SIZE = 32
+MAX_BATCH_BARS = 1024
+
+# Seed of the progression served when a request runs out of time and nothing has been rendered yet, and how long (in
+# milliseconds) such a request waits for it while the pool is starting, before it's turned away:
+FALLBACK_SEED = 0
+FALLBACK_WAIT_MS = float(os.environ.get('GENERATION_FALLBACK_WAIT_MS', 1000))
+
+# Bars in the page's progressions (the only ones kept around to fall back on):
+PAGE_NUMBARS = 4
+
+
+# Raised when a request runs out of time and there's no progression to fall back on yet:
+class GenerationUnavailable(Exception):
+    pass
+
+
+# Runs in every pool process as it starts, so that the first task it gets doesn't pay for imports and loading (or
+# compiling) the sampler at the default randomness:
+def _warm_up():
+    load_tables()
+    render_progression(DEFAULT_RANDOMFACTOR, PAGE_NUMBARS, FALLBACK_SEED)
+
+
+# Renders a batch of progressions, as (randomness, number of bars, seed), in a pool process:
+def _render_batch(jobs: list[tuple[int, int, int]]) -> list[RenderedProgression]:
+    return [render_progression(*job) for job in jobs]
+
+
+# Sends renders to a pool of processes, so that CPU-bound generation runs on every core and outside the web workers.
+# Renders submitted within BATCH_WINDOW of each other are sent as one task, to save a round trip per progression.
+# Every render has a seed, picked by the caller, so it comes out the same wherever it runs.
+# Bulk renders (e.g. for the API) wait in a queue of their own, which is only sent to the pool once the page's renders
+# have been, and only as long as it leaves a process free for them.
+# Like the prefetcher, the pool (and the thread batching renders for it) is only started on first use, so that it
+# belongs to the process serving requests:
+class GenerationExecutor:
+    def __init__(self, processes: int = GENERATION_PROCESSES, batch_window: float = BATCH_WINDOW,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_batch_bars: int = MAX_BATCH_BARS,
+                 fallback_wait: float = FALLBACK_WAIT_MS / 1000):
+        self.processes = processes
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_batch_bars = max_batch_bars
+        self.fallback_wait = fallback_wait
+        self.batches = 0
+        self.renders = 0
+        self._queue = []  # Renders waiting to be sent to the pool, as (job, future)
+        self._bulk_queue = []
+        self._bulk_tasks = 0  # Tasks of bulk renders sent to the pool and not finished yet
+        self._latest = {}  # The last page-sized progression rendered at every randomness, to fall back on
+        self._condition = threading.Condition()
+        self._pool = None
+        self._pid = None
+        self._fallback = None  # The progression for FALLBACK_SEED, rendered as the pool starts
+
+    def submit(self, randomfactor: int, numbars: int, seed: int, bulk: bool = False) -> Future:
+        future = Future()
+        if self.processes <= 0:
+            try:
+                future.set_result(self._finish(render_progression(randomfactor, numbars, seed), recorded=True))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self._condition:
+            self._start()
+            (self._bulk_queue if bulk else self._queue).append(((randomfactor, numbars, seed), future))
+            self._condition.notify()
+        return future
+
+    # Starts the pool ahead of the first render (e.g. as a gunicorn worker boots), so that its processes are warmed up
+    # (and the fallback progression rendered) by the time requests come in:
+    def start(self):
+        if self.processes <= 0:
+            return
+        with self._condition:
+            self._start()
+            self._get_pool()
+
+    def render(self, randomfactor: int, numbars: int, seed: int, bulk: bool = False) -> RenderedProgression:
+        return self.submit(randomfactor, numbars, seed, bulk).result()
+
+    # Renders a progression, unless it takes longer than the deadline (in seconds), in which case it's left to finish
+    # in the background (and be cached) and a page-sized fallback is returned instead:
+    def render_within(self, deadline: float, randomfactor: int, numbars: int, seed: int) -> RenderedProgression:
+        future = self.submit(randomfactor, numbars, seed)
+        try:
+            return future.result(timeout=deadline)
+        except TimeoutError:
+            METRICS.count('ohmychord_generation_deadline_misses_total')
+            future.add_done_callback(_cache_late_result)
+        except Exception as e:
+            logger.exception('rendering a progression failed')
+            METRICS.count('ohmychord_generation_failures_total', exception=type(e).__name__)
+        return self.fallback(randomfactor)
+
+    # A progression to serve instead of one that missed its deadline: the last page-sized one rendered at the same
+    # randomness, or else at the nearest randomness rendered so far, or else the one for FALLBACK_SEED, which is the
+    # first render sent to the pool as it starts. None of them are rendered here, in the web worker (unless everything
+    # is rendered inline). Raises GenerationUnavailable if the FALLBACK_SEED one isn't ready within fallback_wait:
+    def fallback(self, randomfactor: int) -> RenderedProgression:
+        latest = self._latest.get(randomfactor)
+        source = 'latest'
+        if (latest is None) and self._latest:
+            latest = self._latest[min(list(self._latest), key=lambda rendered: abs(rendered - randomfactor))]
+            source = 'nearest'
+        if latest is None:
+            source = 'seed'
+            if self.processes <= 0:
+                latest = render_seeded_progression(FALLBACK_SEED, randomfactor, PAGE_NUMBARS)
+            else:
+                with self._condition:
+                    self._start()
+                    fallback = self._fallback
+                try:
+                    latest = fallback.result(timeout=self.fallback_wait)
+                except Exception as e:
+                    METRICS.count('ohmychord_generation_unavailable_total', exception=type(e).__name__)
+                    raise GenerationUnavailable('no progression to fall back on yet') from e
+        METRICS.count('ohmychord_generation_fallbacks_total', source=source)
+        return latest
+
+    def _finish(self, progression: RenderedProgression, recorded: bool = False) -> RenderedProgression:
+        if not recorded:  # Draws counted and stages timed in a pool process don't make it back to this one's metrics
+            DRAW_COUNTERS.record(progression.randomfactor, progression.numbars, progression.draws)
+            METRICS.record_durations(progression.durations)
+        if progression.numbars == PAGE_NUMBARS:
+            self._latest[progression.randomfactor] = progression
+        self.renders += 1
+        return progression
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        # Processes and threads don't survive a fork, so a pool (and renders queued for it) inherited from another
+        # process are useless here:
+        self._pid = os.getpid()
+        self._pool = None
+        self._queue = []
+        self._queue_fallback()
+        self._bulk_queue = []
+        self._bulk_tasks = 0
+        threading.Thread(target=self._dispatch, name='generation-dispatch', daemon=True).start()
+
+    # Pool processes are spawned rather than forked from this one, which has threads of its own. Process pools are only
+    # imported here, so workers that render inline never pay for importing them:
+    def _get_pool(self) -> 'ProcessPoolExecutor':
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_warm_up)
+        return self._pool
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while self._next_queue() is None:
+                    self._condition.wait()
+                backlog = len(self._next_queue())
+            if backlog < self.max_batch_size:  # Otherwise there's a full batch waiting already
+                time.sleep(self.batch_window)
+            with self._condition:
+                queue = self._next_queue()
+                bulk = queue is self._bulk_queue
+                batch = self._take_batch(queue)
+                if bulk:
+                    self._bulk_tasks += 1
+                pool = self._get_pool()
+            try:
+                task = pool.submit(_render_batch, [job for job, _ in batch])
+            except Exception as e:
+                self._fail(batch, e, bulk)
+                continue
+            self.batches += 1
+            task.add_done_callback(lambda task, batch=batch, bulk=bulk: self._resolve(task, batch, bulk))
+
+    # The queue the next batch is taken from: the page's renders, or else bulk ones, as long as they'd leave a process
+    # free (or, with a single process, one task at a time):
+    def _next_queue(self) -> list | None:
+        if self._queue:
+            return self._queue
+        if self._bulk_queue and (self._bulk_tasks < max(self.processes - 1, 1)):
+            return self._bulk_queue
+        return None
+
+    # Takes the first render off a queue, along with the ones after it of the same number of bars, as many as fit in a
+    # task:
+    def _take_batch(self, queue: list) -> list[tuple[tuple[int, int, int], Future]]:
+        numbars = queue[0][0][1]
+        size = max(min(self.max_batch_size, self.max_batch_bars // max(numbars, 1)), 1)
+        batch = []
+        rest = []
+        for render in queue:
+            (batch if (len(batch) < size) and (render[0][1] == numbars) else rest).append(render)
+        queue[:] = rest
+        return batch
+
+    def _resolve(self, task: Future, batch: list[tuple[tuple[int, int, int], Future]], bulk: bool = False):
+        exception = task.exception()
+        if exception is not None:
+            self._fail(batch, exception, bulk)
+            return
+        self._task_done(bulk)
+        for (_, future), progression in zip(batch, task.result()):
+            future.set_result(self._finish(progression))
+
+    def _task_done(self, bulk: bool):
+        if bulk:
+            with self._condition:
+                self._bulk_tasks -= 1
+                self._condition.notify()
+
+    # Sends the FALLBACK_SEED progression to the pool ahead of anything else waiting (again, if it failed):
+    def _queue_fallback(self):
+        self._fallback = Future()
+        self._queue.insert(0, ((DEFAULT_RANDOMFACTOR, PAGE_NUMBARS, FALLBACK_SEED), self._fallback))
+
+    def _fail(self, batch: list[tuple[tuple[int, int, int], Future]], exception: BaseException, bulk: bool = False):
+        from concurrent.futures.process import BrokenProcessPool
+        self._task_done(bulk)
+        if isinstance(exception, BrokenProcessPool):
+            # A pool process died (e.g. it was killed for using too much memory), so the next batch gets a new pool:
+            with self._condition:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                    self._pool = None
+        for _, future in batch:
+            future.set_exception(exception)
+        with self._condition:
+            if self._fallback.done() and (self._fallback.exception() is not None):
+                self._queue_fallback()
+                self._condition.notify()
+
+
+# A progression that missed its request's deadline still gets cached, so its URL works if it's shared later:
+def _cache_late_result(future: Future):
+    if future.exception() is None:
+        cache_progression(future.result())
@@ -0,0 +1,19 @@
+import gc
+import os
+
+# Loads the app (and its precomputed tables, see tablecache.py) once in the master before forking the workers, so
+# they start serving right away and share what the master loaded copy-on-write. GUNICORN_PRELOAD=0 loads the app in
+# every worker instead (e.g. to use --reload):
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+# Moves everything the master has loaded out of the garbage collector's reach, so that collections in the workers
+# don't write to (and so copy) the pages they share with it:
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+# Starts every worker's generation pool as the worker boots, rather than on its first request:
+def post_worker_init(worker):
+    from app import EXECUTOR
+    EXECUTOR.start()
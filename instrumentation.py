@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+
+# Debug output goes through logging, and stays off unless LOG_LEVEL asks for it:
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+
+# Upper bounds (in seconds) of the buckets durations are counted in:
+DURATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket counts everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Counters and histograms of this process, labeled (e.g. by stage), and rendered in the Prometheus text format.
+# Collectors are called on every render to add metrics kept elsewhere (caches, pools), as (name, type, labels, value):
+class Metrics:
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    # Times a stage of serving a request, and counts the exceptions it raises by type. The duration is also kept in
+    # durations, if given (e.g. to be recorded by another process, see record_durations()):
+    @contextmanager
+    def timed(self, stage: str, durations: dict[str, float] | None = None) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.count('ohmychord_stage_exceptions_total', stage=stage, exception=type(e).__name__)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('ohmychord_stage_duration_seconds', duration, stage=stage)
+            if durations is not None:
+                durations[stage] = duration
+
+    # Records stage durations timed elsewhere (e.g. in a process pool), as timed() would have:
+    def record_durations(self, durations: dict[str, float]):
+        for stage, duration in durations.items():
+            self.observe('ohmychord_stage_duration_seconds', duration, stage=stage)
+
+    def add_collector(self, collector: Callable[[], Iterable[tuple[str, str, dict, float]]]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count))
+                                for key, h in self._histograms.items())
+        lines = []
+        types = {}
+        for (name, labels), value in counters:
+            _declare(lines, types, name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            _declare(lines, types, name, 'histogram')
+            cumulative = 0
+            for bound, bucketcount in zip(buckets + (float('inf'),), counts):
+                cumulative += bucketcount
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        for collector in self._collectors:
+            for name, metrictype, labels, value in collector():
+                _declare(lines, types, name, metrictype)
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _declare(lines: list[str], types: dict[str, str], name: str, metrictype: str):
+    if name not in types:
+        types[name] = metrictype
+        lines.append(f'# TYPE {name} {metrictype}')
+
+
+def _labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+# Memory of this process, in bytes, for METRICS.add_collector(). Resident memory counts pages shared with other
+# processes (e.g. with the master a worker was forked from) in full, proportional memory splits them between the
+# processes sharing them, and unique memory leaves them out (Linux only; elsewhere just the peak resident memory):
+def process_memory() -> list[tuple[str, str, dict, float]]:
+    try:
+        with open('/proc/self/smaps_rollup') as smapsfile:
+            smaps = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in smapsfile if line.endswith('kB\n')}
+    except OSError:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return [('ohmychord_process_max_resident_bytes', 'gauge', {},
+                 maxrss if sys.platform == 'darwin' else maxrss * 1024)]
+    return [('ohmychord_process_resident_bytes', 'gauge', {}, smaps.get('Rss', 0)),
+            ('ohmychord_process_proportional_bytes', 'gauge', {}, smaps.get('Pss', 0)),
+            ('ohmychord_process_unique_bytes', 'gauge', {},
+             smaps.get('Private_Clean', 0) + smaps.get('Private_Dirty', 0))]
+
+
+METRICS = Metrics()
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+import threading
+
+
+# A thread-safe least-recently-used cache, bounded by its number of entries and, optionally, by the total size of its
+# values (as measured by sizeof):
+class LRUCache:
+    def __init__(self, maxsize: int, maxbytes: int | None = None, sizeof: Callable[[Any], int] = len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.currentbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        if (self.maxbytes is not None) and (size > self.maxbytes):
+            return  # Would push out everything else and still not fit
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = value
+            self.currentbytes += size
+            while ((len(self._entries) > self.maxsize)
+                   or ((self.maxbytes is not None) and (self.currentbytes > self.maxbytes))):
+                self._remove(next(iter(self._entries)))
+
+    # Returns the cached value, or makes it with create() and caches it (outside the lock, so concurrent misses on the
+    # same key may each create it):
+    def get_or_create(self, key: Hashable, create: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.currentbytes = 0
+
+    def _remove(self, key: Hashable):
+        value = self._entries.pop(key)
+        if self.maxbytes is not None:
+            self.currentbytes -= self.sizeof(value)
+
+
+_MISSING = object()
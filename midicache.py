@@ -0,0 +1,37 @@
+from chordtypes import Chord
+from chordgenerator import voicings_to_midi_bytes
+from lrucache import LRUCache
+from typing import Iterable
+import hashlib
+
+# Total size of the MIDI kept in memory, per process (a 4-bar progression renders to a couple hundred bytes):
+MIDI_CACHE_MAX_BYTES = 8 * 1024 * 1024
+MIDI_CACHE_MAX_ENTRIES = 65536
+
+# Rendered MIDI by digest:
+MIDI_CACHE = LRUCache(MIDI_CACHE_MAX_ENTRIES, maxbytes=MIDI_CACHE_MAX_BYTES)
+
+
+# Everything a progression's MIDI depends on, as text: four hex digits per bar, the chord's root followed by its pitch
+# classes as a 12-bit mask. Progressions that sound the same have the same token, however their chords are spelled:
+def midi_token(chords_: Iterable[Chord]) -> str:
+    return ''.join(f'{chord.root:x}{chord.mask:03x}' for chord in chords_)
+
+
+def parse_midi_token(token: str) -> list[tuple[int, int]]:
+    if (len(token) % 4 != 0) or not all(c in '0123456789abcdef' for c in token):
+        raise ValueError(f"invalid MIDI token '{token}'")
+    voicings = [(int(token[i], 16), int(token[i + 1:i + 4], 16)) for i in range(0, len(token), 4)]
+    if any(root > 11 for root, _ in voicings):
+        raise ValueError(f"invalid MIDI token '{token}'")
+    return voicings
+
+
+# Content address of a progression's MIDI (also its ETag):
+def midi_digest(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+# Returns the MIDI for a token, rendering it only if it isn't already cached:
+def midi_bytes(token: str) -> bytes:
+    return MIDI_CACHE.get_or_create(midi_digest(token), lambda: voicings_to_midi_bytes(parse_midi_token(token)))
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Callable, Hashable, Any
+import os
+import threading
+
+# How many ready results to keep per bucket, and how many threads render them (0 turns prefetching off):
+PREFETCH_DEPTH = int(os.environ.get('PREFETCH_DEPTH', 4))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 1))
+
+
+# Keeps a queue of results rendered ahead of time for every bucket that gets asked for, topping it back up in the
+# background after each request. When a bucket has nothing ready, the result is rendered inline instead (by the render
+# given to get(), if any, e.g. one that gives up sooner).
+# The thread pool is only started on first use, so that it belongs to the process serving requests (e.g. a gunicorn
+# worker, rather than the master it was forked from):
+class Prefetcher:
+    def __init__(self, render: Callable[[Hashable], Any], depth: int = PREFETCH_DEPTH, workers: int = PREFETCH_WORKERS):
+        self.render = render
+        self.depth = depth
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._ready = {}  # Results rendered ahead of time, by bucket
+        self._pending = {}  # Renders submitted but not finished yet, by bucket
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def get(self, bucket: Hashable, render: Callable[[Hashable], Any] | None = None) -> Any:
+        with self._lock:
+            ready = self._ready.get(bucket)
+            result = ready.popleft() if ready else None
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.refill(bucket)
+        if result is not None:
+            return result
+        return (render or self.render)(bucket)
+
+    # Starts rendering enough results in the background to bring a bucket back up to depth:
+    def refill(self, bucket: Hashable):
+        if (self.depth <= 0) or (self.workers <= 0):
+            return
+        with self._lock:
+            executor = self._get_executor()
+            missing = self.depth - len(self._ready.get(bucket, ())) - self._pending.get(bucket, 0)
+            if missing <= 0:
+                return
+            self._pending[bucket] = self._pending.get(bucket, 0) + missing
+        for _ in range(missing):
+            executor.submit(self._render_ahead, bucket)
+
+    def _render_ahead(self, bucket: Hashable):
+        result = None
+        try:
+            result = self.render(bucket)
+        finally:
+            with self._lock:
+                self._pending[bucket] -= 1
+                if result is not None:
+                    self._ready.setdefault(bucket, deque()).append(result)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor_pid != os.getpid():
+            # Threads don't survive a fork, so a pool (and renders pending in it) inherited from another process are
+            # useless here:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+            self._executor_pid = os.getpid()
+            self._pending.clear()
+        return self._executor
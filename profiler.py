@@ -0,0 +1,354 @@
+from chordgenerator import (GENERATION_ERRORS, generatechords, generatechords_batch, key_center_distance,
+                            process_roman_numeral_analysis, chords_to_chordsymbols)
+from chordtypes import QUALITY_MASKS
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+
+# Randomness slider values (in percent) profiled by default, and how many progressions are sampled at each:
+RANDOMFACTORS = tuple(range(0, 101, 10))
+SAMPLES = 100_000
+
+# Progressions per shard (the unit of work sent to a process, and of progress saved in a checkpoint):
+SHARD_SIZE = 10_000
+
+# Most time (in seconds) between checkpoints:
+CHECKPOINT_INTERVAL = 60
+
+# Distances a key can be from another around the circle of fifths, 0-6:
+KEY_DISTANCES = 7
+
+# Chance of --check-batch flagging a statistic that generatechords_batch() and generatechords() have the same
+# distribution of (so, with three statistics per randomness, most runs over many randomness values pass):
+CHECK_SIGNIFICANCE = 0.001
+
+
+# Counts over the progressions sampled at one randomness slider value, as NumPy histograms (and counters, for the
+# names of numerals, chord qualities and exceptions, which aren't known ahead of time). Adding up two of them gives
+# the counts of both samples together, so shards can be counted separately, in any order:
+class ProgressionStats:
+    def __init__(self, numbars: int):
+        self.numbars = numbars
+        self.samples = 0
+        self.exceptions = Counter()  # Progressions thrown out, by '<stage>:<exception type>'
+        self.unnamed = 0  # Progressions with a chord that doesn't have a symbol
+        self.modulations = np.zeros(numbars, dtype=np.int64)  # Progressions by how many times they change key
+        self.key_distances = np.zeros(KEY_DISTANCES, dtype=np.int64)  # Bars by distance from the starting key
+        self.degrees = np.zeros(7, dtype=np.int64)  # Bars by scale degree of their roman numeral
+        self.modes = np.zeros(2, dtype=np.int64)  # Bars in major keys, then minor ones
+        self.numerals = Counter()  # Bars by roman numeral analysis
+        self.qualities = Counter()  # Bars by chord quality, as its semitones above the root (e.g. '0-4-7')
+
+    def add(self, chords: list, keys: list[str], degrees: list[int], numerals: list[str]):
+        self.modulations[sum(k1 != k2 for k1, k2 in zip(keys, keys[1:]))] += 1
+        np.add.at(self.key_distances, [key_center_distance(keys[0], k) for k in keys], 1)
+        np.add.at(self.degrees, degrees, 1)
+        np.add.at(self.modes, [int(k[0].islower()) for k in keys], 1)
+        self.numerals.update(numerals)
+        self.qualities.update(_quality_name(c.quality) for c in chords)
+
+    def merge(self, other: 'ProgressionStats'):
+        self.samples += other.samples
+        self.exceptions += other.exceptions
+        self.unnamed += other.unnamed
+        self.modulations += other.modulations
+        self.key_distances += other.key_distances
+        self.degrees += other.degrees
+        self.modes += other.modes
+        self.numerals += other.numerals
+        self.qualities += other.qualities
+
+    # Rates and distributions worked out from the counts:
+    def summary(self) -> dict:
+        failures = sum(self.exceptions.values())
+        succeeded = self.samples - failures
+        bars = int(self.key_distances.sum())
+        return {'samples': self.samples,
+                'failure_rate': failures / self.samples if self.samples else 0.0,
+                'unnamed_rate': self.unnamed / succeeded if succeeded else 0.0,
+                # Key changes per bar-to-bar transition:
+                'modulation_rate': (float(self.modulations @ np.arange(self.numbars)) / (succeeded * (self.numbars - 1))
+                                    if succeeded and self.numbars > 1 else 0.0),
+                'key_distances': (self.key_distances / bars).tolist() if bars else [],
+                'minor_rate': float(self.modes[1] / bars) if bars else 0.0,
+                'numerals': {n: c / bars for n, c in self.numerals.most_common()} if bars else {}}
+
+    def to_dict(self) -> dict:
+        return {'numbars': self.numbars, 'samples': self.samples, 'exceptions': dict(self.exceptions),
+                'unnamed': self.unnamed, 'modulations': self.modulations.tolist(),
+                'key_distances': self.key_distances.tolist(), 'degrees': self.degrees.tolist(),
+                'modes': self.modes.tolist(), 'numerals': dict(self.numerals), 'qualities': dict(self.qualities)}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ProgressionStats':
+        stats = cls(d['numbars'])
+        stats.samples = d['samples']
+        stats.unnamed = d['unnamed']
+        for name in ('exceptions', 'numerals', 'qualities'):
+            setattr(stats, name, Counter(d[name]))
+        for name in ('modulations', 'key_distances', 'degrees', 'modes'):
+            setattr(stats, name, np.array(d[name], dtype=np.int64))
+        return stats
+
+
+# Quality codes depend on the order chords were first seen in, which differs between processes, so qualities are
+# counted by name:
+def _quality_name(quality: int) -> str:
+    return '-'.join(str(pc) for pc in range(12) if QUALITY_MASKS[quality] & (1 << pc))
+
+
+# Seeds of the shards are spawned from the run's seed, keyed by randomness and shard number, so that every shard draws
+# its own independent stream, and comes out the same whichever process counts it (or whichever run, when resuming):
+def shard_rng(seed: int, randomfactor: int, shard: int) -> np.random.Generator:
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(randomfactor, shard)))
+
+
+# Samples a shard's progressions the way the page used to generate them (throwing out the ones the generator or the
+# analysis raises on), and counts them:
+def profile_shard(seed: int, randomfactor: int, shard: int, numbars: int,
+                  shard_size: int = SHARD_SIZE) -> ProgressionStats:
+    rng = shard_rng(seed, randomfactor, shard)
+    factor = 1 - (randomfactor / 100)  # As the page turns its slider into the generator's factors
+    stats = ProgressionStats(numbars)
+    stats.samples = shard_size
+    for _ in range(shard_size):
+        try:
+            chords, keys, degrees = generatechords(factor, factor, numbars, seed=rng)
+        except GENERATION_ERRORS as e:
+            stats.exceptions[f'generate:{type(e).__name__}'] += 1
+            continue
+        try:
+            numerals = process_roman_numeral_analysis(chords, keys, degrees)
+        except GENERATION_ERRORS as e:
+            stats.exceptions[f'analysis:{type(e).__name__}'] += 1
+            continue
+        if chords_to_chordsymbols(chords) is None:
+            stats.unnamed += 1
+        stats.add(chords, keys, degrees, numerals)
+    return stats
+
+
+# Statistics of a progression --check-batch compares, as (name, value). Each one is counted once per progression, so
+# that counts from different progressions are independent. Like qualities, chords are counted by their spelling rather
+# than their id:
+def _check_statistics(chords: list, keys: list[str]) -> list[tuple[str, object]]:
+    return [('startingkey', keys[0]), ('lastchord', tuple(chords[-1])),
+            ('modulations', sum(k1 != k2 for k1, k2 in zip(keys, keys[1:])))]
+
+
+# Counts the statistics of a shard's progressions from generatechords(), leaving out the ones it raises on (which
+# generatechords_batch() is meant to leave out too):
+def check_shard(seed: int, randomfactor: int, shard: int, numbars: int,
+                shard_size: int = SHARD_SIZE) -> Counter:
+    rng = shard_rng(seed, randomfactor, shard)
+    factor = 1 - (randomfactor / 100)
+    counts = Counter()
+    for _ in range(shard_size):
+        try:
+            chords, keys, _ = generatechords(factor, factor, numbars, seed=rng)
+        except GENERATION_ERRORS:
+            continue
+        counts.update(_check_statistics(chords, keys))
+    return counts
+
+
+# Counts the statistics of as many progressions from generatechords_batch() as the shards got from generatechords(),
+# drawn from a stream of their own (the one after the shards'):
+def check_batch(seed: int, randomfactor: int, shards: int, numbars: int, n: int) -> Counter:
+    factor = 1 - (randomfactor / 100)
+    counts = Counter()
+    for progression in generatechords_batch(n, factor, factor, numbars, seed=shard_rng(seed, randomfactor, shards)):
+        counts.update(_check_statistics(progression.chord_list(), progression.key_list()))
+    return counts
+
+
+# Pearson's chi-squared test of whether two samples of a statistic, as counts by value, come from the same
+# distribution. Values too rare for the test (fewer than 5 expected in either sample) are counted together. The
+# p-value is worked out from the Wilson-Hilferty approximation of the chi-squared distribution. Returns (chi-squared,
+# degrees of freedom, p-value):
+def homogeneity_test(counts1: Counter, counts2: Counter) -> tuple[float, int, float]:
+    n1, n2 = sum(counts1.values()), sum(counts2.values())
+    rare = Counter()
+    table = []
+    for value in set(counts1) | set(counts2):
+        if (counts1[value] + counts2[value]) * min(n1, n2) / (n1 + n2) < 5:
+            rare.update({1: counts1[value], 2: counts2[value]})
+        else:
+            table.append((counts1[value], counts2[value]))
+    if rare:
+        table.append((rare[1], rare[2]))
+    df = len(table) - 1
+    if (df < 1) or (not n1) or (not n2):
+        return 0.0, 0, 1.0
+    chi2 = sum((count - total * n / (n1 + n2)) ** 2 / (total * n / (n1 + n2))
+               for c1, c2 in table for count, n, total in ((c1, n1, c1 + c2), (c2, n2, c1 + c2)))
+    z = ((chi2 / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+    return chi2, df, math.erfc(z / math.sqrt(2)) / 2
+
+
+# Compares generatechords_batch() against generatechords() at every randomness, sampling the scalar generator's shards
+# across a pool of processes. Returns the randomness values and statistics whose distributions differ:
+def run_batch_check(seed: int, randomfactors: tuple[int, ...], samples: int, numbars: int,
+                    processes: int | None = None, shard_size: int = SHARD_SIZE,
+                    significance: float = CHECK_SIGNIFICANCE) -> list[tuple[int, str]]:
+    shards = math.ceil(samples / shard_size)
+    scalar_counts = {r: Counter() for r in randomfactors}
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(check_shard, seed, r, shard, numbars, shard_size): r
+                   for r in randomfactors for shard in range(shards)}
+        for future in as_completed(futures):
+            scalar_counts[futures[future]] += future.result()
+    differing = []
+    print(f'{"randomness":>10} {"statistic":<12} {"samples":>9} {"chi2":>10} {"df":>4} {"p":>8}')
+    for r in randomfactors:
+        succeeded = sum(c for (name, _), c in scalar_counts[r].items() if name == 'startingkey')
+        batch_counts = check_batch(seed, r, shards, numbars, succeeded)
+        for name in ('startingkey', 'lastchord', 'modulations'):
+            chi2, df, p = homogeneity_test(Counter({v: c for (n, v), c in scalar_counts[r].items() if n == name}),
+                                           Counter({v: c for (n, v), c in batch_counts.items() if n == name}))
+            print(f'{r:>9}% {name:<12} {succeeded:>9} {chi2:>10.1f} {df:>4} {p:>8.4f}'
+                  + ('  differs' if p < significance else ''))
+            if p < significance:
+                differing.append((r, name))
+    return differing
+
+
+# Progress of a run: its settings, the shards counted so far and their merged counts, by randomness:
+class Checkpoint:
+    def __init__(self, seed: int, numbars: int, shard_size: int):
+        self.seed = seed
+        self.numbars = numbars
+        self.shard_size = shard_size
+        self.done = {}  # Shards counted, by randomness
+        self.stats = {}  # Merged counts, by randomness
+
+    def add(self, randomfactor: int, shard: int, stats: ProgressionStats):
+        self.done.setdefault(randomfactor, set()).add(shard)
+        if randomfactor in self.stats:
+            self.stats[randomfactor].merge(stats)
+        else:
+            self.stats[randomfactor] = stats
+
+    # Written to a temporary file and moved over the old one, so that a run killed mid-write leaves the last one whole:
+    def save(self, path: str):
+        with open(path + '.tmp', 'w') as checkpointfile:
+            json.dump({'seed': self.seed, 'numbars': self.numbars, 'shard_size': self.shard_size,
+                       'done': {r: sorted(shards) for r, shards in self.done.items()},
+                       'stats': {r: stats.to_dict() for r, stats in self.stats.items()}}, checkpointfile)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'Checkpoint':
+        with open(path) as checkpointfile:
+            d = json.load(checkpointfile)
+        checkpoint = cls(d['seed'], d['numbars'], d['shard_size'])
+        checkpoint.done = {int(r): set(shards) for r, shards in d['done'].items()}
+        checkpoint.stats = {int(r): ProgressionStats.from_dict(stats) for r, stats in d['stats'].items()}
+        return checkpoint
+
+
+# Counts every shard the checkpoint doesn't have yet across a pool of processes, saving it as shards come in:
+def run(checkpoint: Checkpoint, randomfactors: tuple[int, ...], samples: int, processes: int | None = None,
+        path: str | None = None, interval: float = CHECKPOINT_INTERVAL) -> Checkpoint:
+    shards = math.ceil(samples / checkpoint.shard_size)  # Samples are rounded up to whole shards
+    pending = [(r, shard) for r in randomfactors for shard in range(shards)
+               if shard not in checkpoint.done.get(r, ())]
+    print(f'{len(pending)} of {shards * len(randomfactors)} shards to go', file=sys.stderr)
+    lastsave = time.monotonic()
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(profile_shard, checkpoint.seed, r, shard, checkpoint.numbars, checkpoint.shard_size):
+                   (r, shard) for r, shard in pending}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                checkpoint.add(*futures[future], future.result())
+                if path and (time.monotonic() - lastsave >= interval):
+                    checkpoint.save(path)
+                    lastsave = time.monotonic()
+                print(f'\r{i}/{len(pending)} shards', end='', file=sys.stderr)
+        finally:
+            # Also when the run is interrupted, so that it resumes from the last shard counted:
+            print(file=sys.stderr)
+            if path:
+                checkpoint.save(path)
+            for future in futures:
+                future.cancel()
+    return checkpoint
+
+
+def report(checkpoint: Checkpoint, randomfactors: tuple[int, ...]) -> dict:
+    return {'metadata': {'seed': checkpoint.seed, 'numbars': checkpoint.numbars, 'shard_size': checkpoint.shard_size,
+                         'numpy': np.__version__},
+            'randomness': {r: dict(checkpoint.stats[r].summary(), counts=checkpoint.stats[r].to_dict())
+                           for r in randomfactors if r in checkpoint.stats}}
+
+
+def format_table(checkpoint: Checkpoint, randomfactors: tuple[int, ...]) -> str:
+    lines = [f'{"randomness":>10} {"samples":>9} {"failed":>7} {"unnamed":>7} {"modulation":>10} {"minor":>6}  '
+             f'key distances 0-6']
+    for r in randomfactors:
+        if r not in checkpoint.stats:
+            continue
+        s = checkpoint.stats[r].summary()
+        lines.append(f'{r:>9}% {s["samples"]:>9} {s["failure_rate"]:>7.2%} {s["unnamed_rate"]:>7.2%} '
+                     f'{s["modulation_rate"]:>10.3f} {s["minor_rate"]:>6.1%}  '
+                     + ' '.join(f'{p:.3f}' for p in s['key_distances']))
+    return '\n'.join(lines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Profiles progression statistics (failures, modulations, key distances, numerals) across the '
+                    'randomness slider, sampling the generator in parallel.')
+    parser.add_argument('-r', '--randomness', type=int, nargs='+', default=RANDOMFACTORS,
+                        help='randomness slider values to profile, in percent')
+    parser.add_argument('-n', '--samples', type=int, default=SAMPLES,
+                        help='progressions to sample per randomness (rounded up to whole shards)')
+    parser.add_argument('-b', '--numbars', type=int, default=4)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-p', '--processes', type=int, default=None, help='processes to sample in (default: all cores)')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('-c', '--checkpoint', help='file to save progress to, and resume from if it exists')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help='most seconds between checkpoints')
+    parser.add_argument('-o', '--output', help='file to write the statistics to, as JSON')
+    parser.add_argument('--check-batch', action='store_true',
+                        help='instead of profiling, check that generatechords_batch() comes out like generatechords() '
+                             '(without the progressions it raises on), exiting with 1 if it doesn\'t')
+    args = parser.parse_args(argv)
+
+    randomfactors = tuple(args.randomness)
+    if any(not 0 <= r <= 100 for r in randomfactors):
+        parser.error('randomness must be between 0 and 100')
+    if args.check_batch:
+        return 1 if run_batch_check(args.seed, randomfactors, args.samples, args.numbars, args.processes,
+                                    args.shard_size) else 0
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        checkpoint = Checkpoint.load(args.checkpoint)
+        if ((checkpoint.seed, checkpoint.numbars, checkpoint.shard_size)
+                != (args.seed, args.numbars, args.shard_size)):
+            parser.error(f'{args.checkpoint} was saved with seed {checkpoint.seed}, {checkpoint.numbars} bars and '
+                         f'shards of {checkpoint.shard_size}, so it can only be resumed with the same')
+    else:
+        checkpoint = Checkpoint(args.seed, args.numbars, args.shard_size)
+
+    try:
+        run(checkpoint, randomfactors, args.samples, args.processes, args.checkpoint, args.checkpoint_interval)
+    except KeyboardInterrupt:
+        if args.checkpoint:
+            print(f'Interrupted, rerun with the same arguments to resume from {args.checkpoint}', file=sys.stderr)
+        return 130
+    print(format_table(checkpoint, randomfactors))
+    if args.output:
+        with open(args.output, 'w') as outputfile:
+            json.dump(report(checkpoint, randomfactors), outputfile, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+from chordgenerator import chords_to_chordsymbols, chords_to_midi_bytes, roman_numeral_symbol
+from chordtypes import Chord, Progression
+from chordsampler import compiled_sampler
+from instrumentation import METRICS
+from lrucache import LRUCache
+from midicache import midi_token, midi_digest
+from colorsys import hsv_to_rgb
+from typing import Callable, NamedTuple
+import logging
+import os
+import secrets
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Randomness slider value the page starts out with, and its range:
+DEFAULT_RANDOMFACTOR = 50
+MIN_RANDOMFACTOR = 0
+MAX_RANDOMFACTOR = 100
+
+# Seeds are non-negative 63-bit integers (so they fit in a signed 64-bit field downstream):
+MAX_SEED = 2 ** 63 - 1
+
+# Bounds on the rendered progressions kept around by (seed, randomness, numbars):
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 4096))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Chord colors by root (pitch class) and quality (major or not):
+CHORD_COLORS = [['#%02x%02x%02x' %
+                 tuple(map(lambda x: round(x * 255), hsv_to_rgb(
+                     ((((root * 15) + (320 if is_major else 140)) % 360) / 360),
+                     0.28, 0.54)))  # s = 0.54-0.57, v = 0.60-0.62 -> s = 0.24-0.32, v = 0.54
+                 for is_major in (False, True)]
+                for root in range(12)]
+
+
+# Everything the page shows for a progression, ready to serve. The progression itself is kept as arrays of ids (these
+# stay in memory by the thousand, in the result cache and prefetch queues), and its chord symbols, numerals and hues
+# are looked up from them when served:
+class RenderedProgression(NamedTuple):
+    randomfactor: int
+    seed: int | None
+    progression: Progression  # With its analyses
+    midi_token: str
+    midi_digest: str
+    midi: bytes
+    draws: int  # Bars drawn to generate it, including the ones backed out of
+    durations: dict[str, float]  # How long (in seconds) every stage of rendering it took
+
+    @property
+    def numbars(self) -> int:
+        return len(self.progression)
+
+    @property
+    def chords(self) -> list[Chord]:
+        return self.progression.chord_list()
+
+    @property
+    def keys(self) -> list[str]:
+        return self.progression.key_list()
+
+    @property
+    def chordsymbols(self) -> list[str]:
+        return chords_to_chordsymbols(self.chords)
+
+    @property
+    def analyses(self) -> list[str]:  # The numerals in plain text (see analyze_bar_shorthand())
+        return self.progression.analysis_list()
+
+    @property
+    def numerals(self) -> list[str]:
+        return [roman_numeral_symbol(analysis) for analysis in self.analyses]
+
+    # Color chords based on quality:
+    @property
+    def hues(self) -> list[str]:
+        return [CHORD_COLORS[c.root][c.is_major] for c in self.chords]
+        # hues = [((note_to_int(c[0]) * 15) + (320 if (major_third(c[0]) == c[1]) else 140)) % 360
+        #         for c in chords]
+
+
+# How many draws progressions took (every bar takes one, plus one for every bar drawn and then backed out of), by
+# randomness slider value:
+class DrawCounters:
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, randomfactor: int, numbars: int, draws: int):
+        with self._lock:
+            counts = self._counts.setdefault(randomfactor, {'progressions': 0, 'bars': 0, 'draws': 0, 'max_draws': 0})
+            counts['progressions'] += 1
+            counts['bars'] += numbars
+            counts['draws'] += draws
+            counts['max_draws'] = max(counts['max_draws'], draws)
+
+    # The counts as metrics, for METRICS.add_collector():
+    def collect(self) -> list[tuple[str, str, dict, float]]:
+        metrics = []
+        for randomfactor, counts in self.snapshot().items():
+            labels = {'randomfactor': str(randomfactor)}
+            metrics += [('ohmychord_progressions_total', 'counter', labels, counts['progressions']),
+                        ('ohmychord_progression_draws_total', 'counter', labels, counts['draws']),
+                        ('ohmychord_progression_retries_total', 'counter', labels, counts['retries']),
+                        ('ohmychord_progression_max_draws', 'gauge', labels, counts['max_draws'])]
+        return sorted(metrics, key=lambda metric: metric[0])
+
+    def snapshot(self) -> dict[int, dict[str, int]]:
+        with self._lock:
+            return {randomfactor: dict(counts, retries=counts['draws'] - counts['bars'])
+                    for randomfactor, counts in sorted(self._counts.items())}
+
+
+DRAW_COUNTERS = DrawCounters()
+
+
+# Rough size of a rendered progression in memory (its MIDI and token, plus its arrays of ids):
+def _rendered_size(progression: RenderedProgression) -> int:
+    return len(progression.midi) + 512 + (16 * progression.numbars)
+
+
+RESULT_CACHE = LRUCache(RESULT_CACHE_MAX_ENTRIES, maxbytes=RESULT_CACHE_MAX_BYTES, sizeof=_rendered_size)
+
+
+def clamp_randomfactor(randomfactor: int) -> int:
+    return min(max(randomfactor, MIN_RANDOMFACTOR), MAX_RANDOMFACTOR)
+
+
+def random_seed() -> int:
+    return secrets.randbelow(MAX_SEED + 1)
+
+
+# Generates a progression for a randomness slider value (in percent), only ever drawing bars that can be analyzed and
+# named, and renders it. The same seed always renders the same progression:
+def render_progression(randomfactor: int, numbars: int = 4, seed: int | None = None) -> RenderedProgression:
+    randomfactor_as_decimal = 1 - (randomfactor / 100)
+    durations = {}
+    logger.debug('randomfactor: %s', randomfactor_as_decimal)
+    with METRICS.timed('generate', durations):
+        progression = compiled_sampler(randomfactor_as_decimal, randomfactor_as_decimal).sample_valid(
+            np.random.default_rng(seed), numbars)
+    DRAW_COUNTERS.record(randomfactor, numbars, progression.draws)
+    chords = progression.chords
+    with METRICS.timed('analyse', durations):
+        # The analyses are worked out once per sampler state, as bars are drawn:
+        packed = Progression.from_lists(chords, progression.keys, progression.numerals, progression.analysis)
+    logger.debug('analyses: %s', progression.analysis)
+    with METRICS.timed('midi_encode', durations):
+        token = midi_token(chords)
+        midi = chords_to_midi_bytes(chords)
+    return RenderedProgression(randomfactor, seed, packed, token, midi_digest(token), midi, progression.draws,
+                               durations)
+
+
+# Renders the progression for a seed (with render_progression, or anything that takes the same arguments), unless it's
+# already cached:
+def render_seeded_progression(seed: int, randomfactor: int, numbars: int = 4,
+                              render: Callable[[int, int, int], RenderedProgression] = render_progression
+                              ) -> RenderedProgression:
+    return RESULT_CACHE.get_or_create((seed, randomfactor, numbars), lambda: render(randomfactor, numbars, seed))
+
+
+# Caches a progression rendered elsewhere (e.g. ahead of time), so its URL is served from the cache:
+def cache_progression(progression: RenderedProgression):
+    if progression.seed is not None:
+        RESULT_CACHE.put((progression.seed, progression.randomfactor, progression.numbars), progression)
@@ -0,0 +1,92 @@
+from typing import Iterable, Sequence
+
+# Layout of the Standard MIDI Files the app writes: every bar is a block chord held for most of the bar, over its root
+# doubled in two bass octaves, with one program change per track. Events carry their full status byte (no running
+# status), like MIDIUtil writes them:
+TICKS_PER_BEAT = 960
+BEATS_PER_BAR = 4
+NOTE_BEATS = 3.9  # Leaves a short gap before the next bar
+TEMPO = 120  # In BPM
+VELOCITY = 72  # 0-127, as per the MIDI standard
+PROGRAM = 90
+BASS_NOTES = (36, 48)  # Where the root is doubled, as MIDI note numbers of C
+CHORD_NOTE = 60  # MIDI note number of C for the chord tones
+
+# Channels tracks are assigned to in multi-track files (skipping 9, which General MIDI reserves for percussion):
+CHANNELS = [c for c in range(16) if c != 9]
+
+_NOTE_TICKS = round(NOTE_BEATS * TICKS_PER_BEAT)
+_GAP_TICKS = (BEATS_PER_BAR * TICKS_PER_BEAT) - _NOTE_TICKS
+_END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+
+# Variable-length quantity, as delta times are encoded:
+def _vlq(n: int) -> bytes:
+    encoded = [n & 0x7f]
+    n >>= 7
+    while n:
+        encoded.append(0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(reversed(encoded))
+
+
+def _chunk_header(chunktype: bytes, length: int) -> bytes:
+    return chunktype + length.to_bytes(4, 'big')
+
+
+_TEMPO_TRACK = (_chunk_header(b'MTrk', 11) + b'\x00\xff\x51\x03' + (60_000_000 // TEMPO).to_bytes(3, 'big')
+                + _END_OF_TRACK)
+
+# Encoded events of a bar by voicing and channel, starting with the delta time of its first note-on:
+_bar_events = {}
+
+
+# A bar's events, for a voicing given as (root, pitch classes as a 12-bit mask):
+def _encode_bar(voicing: tuple[int, int], channel: int) -> bytes:
+    key = (voicing, channel)
+    if key not in _bar_events:
+        root, mask = voicing
+        pitches = [b + root for b in BASS_NOTES] + [CHORD_NOTE + pc for pc in range(12) if mask & (1 << pc)]
+        note_ons = b'\x00'.join(bytes((0x90 | channel, p, VELOCITY)) for p in pitches)
+        note_offs = b'\x00'.join(bytes((0x80 | channel, p, VELOCITY)) for p in pitches)
+        _bar_events[key] = _vlq(_GAP_TICKS) + note_ons + _vlq(_NOTE_TICKS) + note_offs
+    return _bar_events[key]
+
+
+# A track's chunk, split into pieces to be copied one after another (the first bar starts at the top of the track,
+# rather than after the gap every other bar starts with):
+def _track_pieces(voicings: Iterable[tuple[int, int]], channel: int) -> list[bytes]:
+    bars = [_encode_bar(voicing, channel) for voicing in voicings]
+    if bars:
+        bars[0] = b'\x00' + bars[0][len(_vlq(_GAP_TICKS)):]
+    program_change = b'\x00' + bytes((0xc0 | channel, PROGRAM))
+    length = len(program_change) + sum(map(len, bars)) + len(_END_OF_TRACK)
+    return [_chunk_header(b'MTrk', length), program_change] + bars + [_END_OF_TRACK]
+
+
+# Writes the pieces of a file into one preallocated buffer:
+def _assemble(tracks: list[list[bytes]]) -> bytes:
+    pieces = [_chunk_header(b'MThd', 6), (1).to_bytes(2, 'big'), (len(tracks) + 1).to_bytes(2, 'big'),
+              TICKS_PER_BEAT.to_bytes(2, 'big'), _TEMPO_TRACK]
+    for track in tracks:
+        pieces += track
+    output = bytearray(sum(map(len, pieces)))
+    position = 0
+    for piece in pieces:
+        output[position:position + len(piece)] = piece
+        position += len(piece)
+    return bytes(output)
+
+
+# Encodes one progression, given as the voicing of every bar:
+def encode_smf(voicings: Iterable[tuple[int, int]]) -> bytes:
+    return _assemble([_track_pieces(voicings, CHANNELS[0])])
+
+
+# Encodes many progressions into one file, either each on its own track (cycling through CHANNELS) or one after
+# another on a single track:
+def encode_smf_batch(progressions: Iterable[Sequence[tuple[int, int]]], back_to_back: bool = False) -> bytes:
+    if back_to_back:
+        return _assemble([_track_pieces((v for voicings in progressions for v in voicings), CHANNELS[0])])
+    return _assemble([_track_pieces(voicings, CHANNELS[i % len(CHANNELS)])
+                      for i, voicings in enumerate(progressions)])
@@ -0,0 +1,101 @@
+from chordsampler import CompiledSampler, compiled_sampler, install_compiled_sampler
+from importlib import metadata
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# Where the precomputed tables are kept (an empty path turns loading them off):
+TABLE_CACHE_PATH = os.environ.get('TABLE_CACHE_PATH',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tables.pickle'))
+
+# Randomness slider values (in percent) precomputed by default (the one the page starts out with):
+RANDOMFACTORS = (50,)
+
+# Modules the tables are worked out from. Tables built from other versions of them (or of mingus, which spells the
+# chords and keys) are stale, and ignored:
+_SOURCES = ('chordtypes.py', 'theorytables.py', 'chordgenerator.py', 'chordsampler.py')
+
+# Samplers loaded from the table cache by this process, and how long (in seconds) loading them took:
+loaded_samplers = 0
+load_seconds = 0.0
+
+
+def fingerprint() -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for source in _SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), 'rb') as sourcefile:
+            digest.update(sourcefile.read())
+    try:
+        digest.update(metadata.version('mingus').encode())
+    except metadata.PackageNotFoundError:
+        pass
+    return digest.hexdigest()
+
+
+# Compiles the samplers for randomness slider values all the way through, as the page turns them into slider factors:
+def build_tables(randomfactors: tuple[int, ...] = RANDOMFACTORS) -> list[CompiledSampler]:
+    samplers = []
+    for randomfactor in randomfactors:
+        sampler = compiled_sampler(1 - (randomfactor / 100), 1 - (randomfactor / 100))
+        sampler.compile_all()
+        samplers.append(sampler)
+    return samplers
+
+
+# Written to a temporary file and moved over the old one, so that workers starting meanwhile never see half a file:
+def save_tables(samplers: list[CompiledSampler], path: str = TABLE_CACHE_PATH):
+    with open(path + '.tmp', 'wb') as tablefile:
+        pickle.dump({'fingerprint': fingerprint(), 'samplers': samplers}, tablefile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+# Installs the precomputed samplers, so compiled_sampler() returns them (fully compiled) rather than compiling states
+# as requests reach them. Without a table cache, or with a stale one, samplers are compiled as before:
+def load_tables(path: str = TABLE_CACHE_PATH) -> int:
+    global loaded_samplers, load_seconds
+    if not path or not os.path.exists(path):
+        logger.info('no precomputed tables at %r, compiling samplers as they are used', path)
+        return 0
+    start = time.perf_counter()
+    with open(path, 'rb') as tablefile:
+        tables = pickle.load(tablefile)
+    if tables.get('fingerprint') != fingerprint():
+        logger.warning('precomputed tables at %r are stale (rebuild them with tablecache.py), ignoring them', path)
+        return 0
+    for sampler in tables['samplers']:
+        install_compiled_sampler(sampler)
+    loaded_samplers = len(tables['samplers'])
+    load_seconds = time.perf_counter() - start
+    logger.info('loaded %d precomputed samplers from %r in %.3fs', loaded_samplers, path, load_seconds)
+    return loaded_samplers
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Precomputes the compiled samplers for randomness slider values, for workers to load on start.')
+    parser.add_argument('-r', '--randomness', type=int, nargs='+', default=RANDOMFACTORS,
+                        help='randomness slider values to precompute, in percent')
+    parser.add_argument('--all', action='store_true', help='precompute every randomness slider value (slow)')
+    parser.add_argument('-o', '--output', default=TABLE_CACHE_PATH, help='file to write the tables to')
+    args = parser.parse_args(argv)
+
+    randomfactors = tuple(range(101)) if args.all else tuple(args.randomness)
+    if any(not 0 <= r <= 100 for r in randomfactors):
+        parser.error('randomness must be between 0 and 100')
+    start = time.perf_counter()
+    samplers = build_tables(randomfactors)
+    save_tables(samplers, args.output)
+    print(f'{sum(len(s.states) for s in samplers)} states at {len(samplers)} randomness values compiled in '
+          f'{time.perf_counter() - start:.1f}s, {os.path.getsize(args.output) / 1024 / 1024:.1f} MiB written to '
+          f'{args.output}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
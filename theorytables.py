@@ -0,0 +1,109 @@
+from mingus.core import chords, notes, keys, intervals
+from mingus.core.mt_exceptions import NoteFormatError
+from chordtypes import Chord, CHORDS, intern_chord
+import numpy as np
+
+# Chords diatonic to the major scale:
+MAJOR_DIATONIC_CHORDS = [chords.major_triad,
+                         chords.minor_seventh,
+                         chords.minor_seventh,
+                         chords.major_seventh,
+                         chords.dominant_seventh,
+                         chords.minor_seventh,
+                         chords.half_diminished_seventh]
+
+# Chords diatonic to the minor scale:
+MINOR_DIATONIC_CHORDS = [chords.minor_triad,
+                         chords.half_diminished_seventh,
+                         chords.major_seventh,
+                         chords.minor_seventh,
+                         chords.minor_seventh,
+                         chords.major_seventh,
+                         chords.dominant_seventh]
+
+# Every key signature mingus recognizes. A key's spelling carries through to the spelling of its chords (Cb vs. B),
+# so the scale and chord tables are keyed by name, while distances (KEY_DISTANCES) only depend on pitch class and mode:
+KEY_NAMES = keys.major_keys + keys.minor_keys
+
+# Note names (with sharps) indexed by pitch class:
+PITCH_CLASS_NAMES = [notes.int_to_note(x) for x in range(12)]
+
+# Scale of every key:
+KEY_SCALES = {k: keys.get_notes(k) for k in KEY_NAMES}
+
+# Chords diatonic to every key, indexed by scale degree:
+DIATONIC_CHORDS = {k: [intern_chord((MAJOR_DIATONIC_CHORDS if k[0].isupper() else MINOR_DIATONIC_CHORDS)[i]
+                                    (KEY_SCALES[k][i]))
+                       for i in range(7)]
+                   for k in KEY_NAMES}
+
+# Harmonic minor substitutes for the v and VII chords of every minor key (V7 and vii°7):
+HARMONIC_MINOR_CHORDS = {k: {4: intern_chord(chords.dominant_seventh(KEY_SCALES[k][4])),
+                             6: intern_chord(chords.diminished_seventh(notes.augment(KEY_SCALES[k][6])))}
+                         for k in keys.minor_keys}
+
+# Tonic triad of every key:
+TONIC_TRIADS = {k: intern_chord(chords.I(k)) for k in KEY_NAMES}
+
+
+# Table lookups that fail the same way mingus does for keys it doesn't recognize:
+def key_scale(key: str) -> list[str]:
+    try:
+        return KEY_SCALES[key]
+    except KeyError:
+        raise NoteFormatError(f"unrecognized format for key '{key}'") from None
+
+
+def key_chords(key: str) -> list[Chord]:
+    try:
+        return DIATONIC_CHORDS[key]
+    except KeyError:
+        raise NoteFormatError(f"unrecognized format for key '{key}'") from None
+
+
+def tonic_triad(key: str) -> Chord:
+    try:
+        return TONIC_TRIADS[key]
+    except KeyError:
+        raise NoteFormatError(f"unrecognized format for key '{key}'") from None
+
+
+# Index of every key into KEY_DISTANCES (pitch class of its tonic, plus 12 if it's minor):
+KEY_INDICES = {k: (notes.note_to_int(k) if k[0].isupper() else notes.note_to_int(k[0].upper() + k[1:]) + 12)
+               for k in KEY_NAMES}
+
+
+# Steps around the circle of fifths between the relative majors of two keys, by index:
+def _circle_of_fifths_distance(index1: int, index2: int) -> int:
+    relative_major1 = (index1 + 3) % 12 if index1 >= 12 else index1
+    relative_major2 = (index2 + 3) % 12 if index2 >= 12 else index2
+    fifths = (7 * (relative_major2 - relative_major1)) % 12
+    return min(fifths, 12 - fifths)
+
+
+KEY_DISTANCES = np.array([[_circle_of_fifths_distance(i, j) for j in range(24)] for i in range(24)], dtype=np.int8)
+
+
+AUGMENTED_FIFTHS = {}
+
+
+# The same chord with its fifth raised (augmented dominants):
+def augment_fifth(chord: Chord) -> Chord:
+    if chord not in AUGMENTED_FIFTHS:
+        AUGMENTED_FIFTHS[chord] = intern_chord(chord[:2] + (notes.augment(chord[2]),) + chord[3:])
+    return AUGMENTED_FIFTHS[chord]
+
+
+# Every dominant the generator can augment (after this, CHORDS holds every chord the generator can produce):
+for _chord in ([DIATONIC_CHORDS[k][4] for k in KEY_NAMES] + [HARMONIC_MINOR_CHORDS[k][4] for k in keys.minor_keys]):
+    augment_fifth(_chord)
+
+# Shorthand interval (e.g. 'b3') between every pair of chord roots:
+_chord_roots = {c[0] for c in CHORDS}
+INTERVAL_SHORTHANDS = {(r1, r2): intervals.determine(r1, r2, shorthand=True) for r1 in _chord_roots for r2 in _chord_roots}
+
+
+def interval_shorthand(note1: str, note2: str) -> str:
+    if (note1, note2) not in INTERVAL_SHORTHANDS:
+        INTERVAL_SHORTHANDS[(note1, note2)] = intervals.determine(note1, note2, shorthand=True)
+    return INTERVAL_SHORTHANDS[(note1, note2)]